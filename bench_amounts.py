@@ -0,0 +1,84 @@
+"""Micro-benchmarks for tally_amounts against the original regex-per-call parse_currency.
+
+    python bench_amounts.py [--count 200000] [--repeat 5]
+"""
+import argparse
+import random
+import re
+import timeit
+
+from tally_amounts import parse_amount, parse_amounts
+
+# Shapes seen in Tally exports: plain, negative, grouped with Dr/Cr, currency symbol, (-) prefix
+AMOUNT_FORMATS = (
+    '{:.2f}',
+    '-{:.2f}',
+    '{:,.2f} Dr',
+    '{:,.2f} Cr',
+    '₹ {:,.2f}',
+    '(-){:,.2f}',
+)
+
+
+def legacy_parse_currency(currency_text):
+    """parse_currency as it was before tally_amounts, minus its per-value logging"""
+    if not currency_text:
+        return 0.0
+    try:
+        clean_text = re.sub(r'[₹,\s]', '', currency_text)
+        clean_text = re.sub(r'\s*(Dr|Cr)\s*', '', clean_text, flags=re.IGNORECASE)
+        match = re.search(r'-?\d+\.?\d*', clean_text)
+        return float(match.group()) if match else float(clean_text) if clean_text else 0.0
+    except ValueError:
+        return 0.0
+
+
+def indian_grouping(text):
+    """Regroup a western-grouped number as 12,34,567.00"""
+    whole, _, fraction = text.partition('.')
+    digits = whole.replace(',', '')
+    head, tail = digits[:-3], digits[-3:]
+    groups = []
+    while len(head) > 2:
+        groups.insert(0, head[-2:])
+        head = head[:-2]
+    if head:
+        groups.insert(0, head)
+    return ','.join(groups + [tail]) + ('.' + fraction if fraction else '')
+
+
+def sample_amounts(count, seed=42):
+    rng = random.Random(seed)
+    samples = []
+    for _ in range(count):
+        text = rng.choice(AMOUNT_FORMATS).format(rng.uniform(0, 5_000_000))
+        samples.append(re.sub(r'[\d,]+\.\d+', lambda m: indian_grouping(m.group()), text) if ',' in text else text)
+    return samples
+
+
+def best_of(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=200_000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    samples = sample_amounts(args.count)
+    mismatches = sum(1 for text in samples if abs(abs(parse_amount(text)) - abs(legacy_parse_currency(text))) > 1e-9)
+    print(f"{args.count} amounts, {mismatches} magnitude mismatches against legacy parse_currency")
+
+    results = {
+        'legacy parse_currency': best_of(lambda: [legacy_parse_currency(text) for text in samples], args.repeat),
+        'parse_amount': best_of(lambda: [parse_amount(text) for text in samples], args.repeat),
+        'parse_amounts (batch)': best_of(lambda: parse_amounts(samples), args.repeat),
+    }
+    baseline = results['legacy parse_currency']
+    for label, seconds in results.items():
+        print(f"{label:<24} {seconds * 1e9 / args.count:8.0f} ns/value  {baseline / seconds:5.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""Benchmarks for the extractor's parse, fetch, save and API paths against a fake Tally server.
+
+    python bench_extractor.py [--sizes 100,10000,100000] [--requests 500]
+                              [--output bench_report.json] [--baseline old_report.json]
+
+Writes a JSON report. With --baseline, timings more than --tolerance slower
+than the baseline are listed and the exit status is 1.
+"""
+import argparse
+import atexit
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Everything a run writes (databases, backups, the application log) stays in a temp dir;
+# the log file is opened when the extractor module is imported
+BENCH_DIR = tempfile.mkdtemp(prefix='tally-bench-')
+atexit.register(shutil.rmtree, BENCH_DIR, ignore_errors=True)
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('TALLY_LOG_FILE', os.path.join(BENCH_DIR, 'tally_extract.log'))
+
+import tally_extractor_with_api as app_module
+from bench_amounts import legacy_parse_currency, sample_amounts, best_of
+from fake_tally import FakeTallyServer, ledger_collection_xml
+from tally_amounts import parse_amount, parse_amounts
+
+GROUPS = ('Sundry Debtors', 'Sundry Creditors')
+API_ENDPOINTS = (
+    '/api/dashboard-data',
+    '/api/accounts?limit=50',
+    '/api/accounts?type=debtor&sort=name&limit=50',
+    '/api/summary/totals',
+    '/api/summary/ageing',
+    '/api/summary/top?type=debtor&n=10',
+)
+API_KEY = 'bench'
+
+
+def make_extractor(workdir, tally_url):
+    extractor = app_module.TallyDataExtractor({
+        'id': 'bench',
+        'db_path': os.path.join(workdir, 'bench.db'),
+        'backup_dir': os.path.join(workdir, 'backups'),
+        'api_key': API_KEY,
+        'tally_url': tally_url,
+        'groups': list(GROUPS),
+    })
+    # Backups run in a background thread and would skew the timings
+    extractor.schedule_backup = lambda: None
+    return extractor
+
+
+def timed(func, repeat=1):
+    """(best seconds, last result) over repeat runs"""
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def latency_stats(samples):
+    samples = sorted(samples)
+    total = sum(samples)
+    return {
+        'requests': len(samples),
+        'requests_per_second': round(len(samples) / total, 1) if total else None,
+        'p50_ms': round(samples[len(samples) // 2] * 1000, 3),
+        'p99_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 3),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 3),
+    }
+
+
+def bench_parse(extractor, size, repeat):
+    body = ledger_collection_xml(GROUPS[0], size)
+    chunks = [body[offset:offset + app_module.STREAM_CHUNK_SIZE] for offset in range(0, len(body), app_module.STREAM_CHUNK_SIZE)]
+    streaming, accounts = timed(lambda: list(extractor.iter_ledger_accounts(iter(chunks), GROUPS[0])), repeat)
+    legacy, legacy_accounts = timed(lambda: extractor.parse_ledger_data(body.decode('utf-8'), GROUPS[0]), repeat)
+    return {
+        'payload_bytes': len(body),
+        'accounts': len(accounts),
+        'streaming_seconds': round(streaming, 4),
+        'streaming_ledgers_per_second': round(size / streaming),
+        'legacy_seconds': round(legacy, 4),
+        'legacy_accounts': len(legacy_accounts),
+    }
+
+
+def bench_fetch(extractor, server, repeat):
+    single, accounts = timed(lambda: extractor.fetch_ledger_data(GROUPS[0]), repeat)
+    concurrent, (all_accounts, _, _) = timed(extractor.fetch_all_ledgers, repeat)
+    return {
+        'group_seconds': round(single, 4),
+        'group_accounts': len(accounts or []),
+        'all_groups_seconds': round(concurrent, 4),
+        'all_groups_accounts': len(all_accounts),
+        'requests_served': server.requests,
+    }, all_accounts
+
+
+def bench_save(extractor, accounts):
+    insert, changes = timed(lambda: extractor.save_to_database(accounts))
+    unchanged, _ = timed(lambda: extractor.save_to_database(accounts))
+    step = max(len(accounts) // 100, 1)
+    updated = [dict(account, balance=account['balance'] + 1) if index % step == 0 else account
+               for index, account in enumerate(accounts)]
+    update, update_changes = timed(lambda: extractor.save_to_database(updated))
+    return {
+        'accounts': len(accounts),
+        'insert_seconds': round(insert, 4),
+        'inserted': len(changes['inserted']) if changes else None,
+        'unchanged_seconds': round(unchanged, 4),
+        'update_1pct_seconds': round(update, 4),
+        'updated': len(update_changes['updated']) if update_changes else None,
+    }
+
+
+def bench_api(extractor, requests_per_endpoint):
+    extractor.rebuild_dashboard_cache()
+    client = extractor.app.test_client()
+    headers = {'X-API-Key': API_KEY, 'Accept-Encoding': 'gzip'}
+    results = {}
+    for endpoint in API_ENDPOINTS:
+        response = client.get(endpoint, headers=headers)
+        if response.status_code != 200:
+            results[endpoint] = {'error': response.status_code}
+            continue
+        samples = []
+        for _ in range(requests_per_endpoint):
+            started = time.perf_counter()
+            client.get(endpoint, headers=headers).get_data()
+            samples.append(time.perf_counter() - started)
+        results[endpoint] = dict(latency_stats(samples), response_bytes=len(response.get_data()))
+    etag = client.get('/api/dashboard-data', headers=headers).headers.get('ETag')
+    if etag:
+        samples = []
+        for _ in range(requests_per_endpoint):
+            started = time.perf_counter()
+            client.get('/api/dashboard-data', headers=dict(headers, **{'If-None-Match': etag})).get_data()
+            samples.append(time.perf_counter() - started)
+        results['/api/dashboard-data (304)'] = latency_stats(samples)
+    return results
+
+
+def bench_amounts(count, repeat):
+    samples = sample_amounts(count)
+    legacy = best_of(lambda: [legacy_parse_currency(text) for text in samples], repeat)
+    single = best_of(lambda: [parse_amount(text) for text in samples], repeat)
+    batch = best_of(lambda: parse_amounts(samples), repeat)
+    return {
+        'values': count,
+        'legacy_ns_per_value': round(legacy * 1e9 / count),
+        'parse_amount_ns_per_value': round(single * 1e9 / count),
+        'parse_amounts_ns_per_value': round(batch * 1e9 / count),
+    }
+
+
+def run_size(size, args):
+    """Parse, fetch, save and API benchmarks for one ledgers-per-group size"""
+    with tempfile.TemporaryDirectory(dir=BENCH_DIR) as workdir, FakeTallyServer(size) as server:
+        extractor = make_extractor(workdir, server.url)
+        repeat = args.repeat if size <= 10_000 else 1
+        result = {'parse': bench_parse(extractor, size, repeat)}
+        result['fetch'], accounts = bench_fetch(extractor, server, repeat)
+        result['save'] = bench_save(extractor, accounts)
+        result['api'] = bench_api(extractor, args.requests)
+        return result
+
+
+def timing_metrics(report, prefix=''):
+    """Flatten every *_seconds / *_ms / *_ns_per_value figure in a report to {path: value}"""
+    metrics = {}
+    for key, value in report.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            metrics.update(timing_metrics(value, f"{path}."))
+        elif isinstance(value, (int, float)) and key.endswith(('_seconds', '_ms', '_ns_per_value')):
+            metrics[path] = value
+    return metrics
+
+
+def compare(report, baseline, tolerance):
+    """Timings that got more than tolerance (a fraction) slower than the baseline"""
+    current = timing_metrics(report['results'])
+    previous = timing_metrics(baseline.get('results', {}))
+    return [(path, previous[path], value) for path, value in sorted(current.items())
+            if previous.get(path) and value > previous[path] * (1 + tolerance)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='100,10000,100000', help="Comma-separated ledgers per group")
+    parser.add_argument('--requests', type=int, default=500, help="Requests per API endpoint")
+    parser.add_argument('--repeat', type=int, default=3, help="Repeats for parse/fetch timings up to 10k ledgers (best is kept)")
+    parser.add_argument('--output', default='bench_report.json')
+    parser.add_argument('--baseline', help="Earlier report to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed slowdown against the baseline (0.25 = 25%%)")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+
+    report = {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sizes': sizes,
+        'results': {'amounts': bench_amounts(100_000, args.repeat)},
+    }
+    for size in sizes:
+        print(f"Benchmarking {size} ledgers per group...", file=sys.stderr)
+        # The extractor prints progress per request; keep the report output readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            report['results'][str(size)] = run_size(size, args)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report['results'], indent=2))
+    print(f"Report written to {args.output}", file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for path, before, after in regressions:
+            print(f"REGRESSION {path}: {before} -> {after}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
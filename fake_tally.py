@@ -0,0 +1,155 @@
+"""Local stand-in for the Tally Prime XML server, for benchmarks and offline runs.
+
+Answers LedgerUnderGroup collection requests with generated ledgers shaped
+like real Tally exports: the CMPINFO counts block (whose <LEDGER>84</LEDGER>
+is not a ledger), UDF-prefixed elements, LANGUAGENAME.LIST names and about
+one zero-balance ledger in ten.
+
+    python fake_tally.py --ledgers 10000 --port 9000
+"""
+import argparse
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape, quoteattr
+
+NAME_WORDS = ('Shree', 'Ganesh', 'Balaji', 'Krishna', 'Sai', 'Laxmi', 'Om', 'Durga', 'Sharma', 'Gupta', 'Agarwal', 'Patel')
+NAME_SUFFIXES = ('Traders', 'Enterprises', 'Industries', 'Agencies', '& Sons', 'Pvt Ltd', 'Stores', 'Distributors')
+CITIES = ('Delhi', 'Mumbai', 'Ludhiana', 'Jaipur', 'Surat', 'Indore', 'Kanpur', 'Nagpur')
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+def ledger_xml(index, group_name, rng):
+    """One LEDGER element as Tally exports it for the LedgerUnderGroup collection"""
+    name = f"{rng.choice(NAME_WORDS)} {rng.choice(NAME_WORDS)} {rng.choice(NAME_SUFFIXES)} {index}"
+    balance = 0.0 if rng.random() < 0.1 else round(rng.uniform(-2_500_000, 2_500_000), 2)
+    bill_date = f'<BILLDATE TYPE="Date">2024{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}</BILLDATE>' if rng.random() < 0.2 else ''
+    return (
+        f'<LEDGER NAME={quoteattr(name)} RESERVEDNAME="">'
+        f'<ADDRESS.LIST TYPE="String"><ADDRESS>{rng.randint(1, 999)}, Main Road</ADDRESS>'
+        f'<ADDRESS>{rng.choice(CITIES)}</ADDRESS></ADDRESS.LIST>'
+        f'<PARENT TYPE="String">{escape(group_name)}</PARENT>'
+        f'{bill_date}'
+        f'<CLOSINGBALANCE TYPE="Amount">{balance:.2f}</CLOSINGBALANCE>'
+        f'<ALTERID TYPE="Number"> {index + 1}</ALTERID>'
+        f'<UDF:GSTREGTYPE.LIST DESC="`GSTRegType`" ISLIST="YES" TYPE="String" INDEX="1">'
+        f'<UDF:GSTREGTYPE DESC="`GSTRegType`">Regular</UDF:GSTREGTYPE></UDF:GSTREGTYPE.LIST>'
+        f'<LANGUAGENAME.LIST><NAME.LIST TYPE="String"><NAME>{escape(name)}</NAME></NAME.LIST>'
+        f'<LANGUAGEID TYPE="Number"> 1033</LANGUAGEID></LANGUAGENAME.LIST>'
+        '</LEDGER>\r\n'
+    )
+
+
+def ledger_collection_xml(group_name, count, seed=0):
+    """Complete LedgerUnderGroup response body with `count` ledgers, as bytes"""
+    rng = random.Random(f"{seed}:{group_name}")
+    parts = [
+        '<ENVELOPE xmlns:UDF="TallyUDF">\r\n'
+        '<HEADER><VERSION>1</VERSION><STATUS>1</STATUS></HEADER>\r\n'
+        '<BODY><DESC><CMPINFO><COMPANY>0</COMPANY><GROUP>0</GROUP>'
+        f'<LEDGER>84</LEDGER><COSTCATEGORY>0</COSTCATEGORY></CMPINFO></DESC>\r\n'
+        '<DATA><COLLECTION>\r\n'
+    ]
+    parts.extend(ledger_xml(index, group_name, rng) for index in range(count))
+    parts.append('</COLLECTION></DATA></BODY></ENVELOPE>\r\n')
+    return ''.join(parts).encode('utf-8')
+
+
+class FakeTallyServer:
+    """Threaded HTTP server answering Tally collection requests on 127.0.0.1.
+
+    ledgers is the number of ledgers returned per group; latency adds a
+    fixed delay before each response. Generated bodies are cached per group.
+    """
+    def __init__(self, ledgers=100, port=0, latency=0.0, seed=0):
+        self.ledgers = ledgers
+        self.latency = latency
+        self.seed = seed
+        self.requests = 0
+        self.bodies = {}
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def body_for(self, group_name):
+        with self.lock:
+            if group_name not in self.bodies:
+                self.bodies[group_name] = ledger_collection_xml(group_name, self.ledgers, self.seed)
+            return self.bodies[group_name]
+
+    def respond(self, request_xml):
+        collection = re.search(r'<ID>([^<]+)</ID>', request_xml)
+        collection = collection.group(1).strip() if collection else ''
+        if collection == 'LedgerUnderGroup':
+            group = re.search(r'\$Parent = "([^"]*)"', request_xml.replace('&quot;', '"'))
+            return self.body_for(group.group(1) if group else 'Sundry Debtors')
+        if collection == 'CompanyAlterIds':
+            return (f'<ENVELOPE><COMPANY NAME="Bench Company"><ALTMSTID>{self.ledgers}</ALTMSTID>'
+                    '<ALTVCHID>0</ALTVCHID></COMPANY></ENVELOPE>').encode('utf-8')
+        return b'<ENVELOPE></ENVELOPE>'
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                request_xml = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8', 'replace')
+                with server.lock:
+                    server.requests += 1
+                body = server.respond(request_xml)
+                if server.latency:
+                    time.sleep(server.latency)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/xml; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                view = memoryview(body)
+                for offset in range(0, len(body), WRITE_CHUNK_SIZE):
+                    self.wfile.write(view[offset:offset + WRITE_CHUNK_SIZE])
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='fake-tally', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--ledgers', type=int, default=100, help="Ledgers returned per group")
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds to wait before each response")
+    args = parser.parse_args()
+    server = FakeTallyServer(args.ledgers, args.port, args.latency)
+    print(f"Fake Tally serving {args.ledgers} ledgers per group on {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Parsing of Tally amount strings such as '1,23,456.78 Dr', '₹ -450.00' or '(-)1,200.00'"""
+import math
+import re
+from array import array
+
+# Fallback for shapes the scanner does not handle: first number, then an optional Dr/Cr after it
+NUMBER_RE = re.compile(r'\d[\d,]*(?:\.\d*)?|\.\d+')
+DRCR_RE = re.compile(r'(?<![a-z])(dr|cr)\b', re.IGNORECASE)
+CURRENCY_PREFIX = '₹$ '
+
+
+def scan_amount(text):
+    """Parse an amount with digit grouping, currency symbol, Dr/Cr suffix or (-) prefix"""
+    if not text:
+        return 0.0
+    # Common shapes are handled with string methods, which are much cheaper than a regex
+    s = text.replace(',', '').strip()
+    side = 0
+    tail = s[-2:].lower()
+    if tail == 'dr' or tail == 'cr':
+        side = 1 if tail == 'dr' else -1
+        s = s[:-2].rstrip()
+    negative = s.startswith('(-)')
+    if negative:
+        s = s[3:]
+    try:
+        value = float(s.lstrip(CURRENCY_PREFIX))
+    except ValueError:
+        return regex_amount(text)
+    if not math.isfinite(value):
+        return 0.0
+    if side:
+        return abs(value) * side
+    return -value if negative else value
+
+
+def regex_amount(text):
+    match = NUMBER_RE.search(text)
+    if match is None:
+        return 0.0
+    value = float(match.group().replace(',', ''))
+    side = DRCR_RE.search(text, match.end())
+    if side is not None:
+        return value if side.group(1).lower() == 'dr' else -value
+    return -value if '-' in text[:match.start()] else value
+
+
+def parse_amount(text, attrib=None):
+    """Parse a Tally amount to a float, Dr positive and Cr negative.
+
+    attrib is the element's attribute dict; DR="Yes" or CR="Yes" there
+    overrides the sign found in the text. Unparseable text gives 0.0.
+    """
+    try:
+        value = float(text)
+    except (TypeError, ValueError):
+        value = scan_amount(text)
+    else:
+        if not math.isfinite(value):
+            value = 0.0
+    if attrib:
+        if attrib.get('DR', 'No').lower() == 'yes':
+            return abs(value)
+        if attrib.get('CR', 'No').lower() == 'yes':
+            return -abs(value)
+    return value
+
+
+def parse_amounts(texts):
+    """Parse many amount strings into an array('d').
+
+    Goes straight to the scanner: on mixed input a failed float() costs more
+    than scanning. The result supports the buffer protocol, so
+    numpy.frombuffer(result) views it without a copy.
+    """
+    result = array('d')
+    append = result.append
+    for text in texts:
+        append(scan_amount(text))
+    return result
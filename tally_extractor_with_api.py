@@ -1,30 +1,278 @@
 import xml.etree.ElementTree as ET
+from xml.parsers import expat
 import requests
 import sqlite3
-import schedule
+import random
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 import re
-import shutil
+import hashlib
+import gzip
+import glob
+import sys
+import argparse
+import base64
+import queue
 import os
 import logging
+import bisect
 import threading
-from flask import Flask, jsonify, request
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler, WatchedFileHandler
+from urllib.parse import urlparse
+from xml.sax.saxutils import escape
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 from flask_cors import CORS
 from functools import wraps
+from tally_amounts import parse_amount, parse_amounts
 
-# Configure logging
+# Configure logging: level from LOG_LEVEL (DEBUG adds per-ledger detail). gunicorn workers log to
+# stderr for the process manager to collect; the extract/run process writes a size-rotated file of
+# its own. TALLY_LOG_FILE=- always logs to stderr. TALLY_LOG_WATCHED=1 (implied for a file under
+# gunicorn) lets several processes append to one file, which must then be rotated by logrotate, since
+# RotatingFileHandler is not safe across processes
+LOG_FILE = os.environ.get('TALLY_LOG_FILE', 'tally_extract.log')
+UNDER_GUNICORN = 'gunicorn' in sys.modules
+if LOG_FILE == '-' or (UNDER_GUNICORN and 'TALLY_LOG_FILE' not in os.environ):
+    log_handler = logging.StreamHandler()
+elif UNDER_GUNICORN or os.environ.get('TALLY_LOG_WATCHED', '0') == '1':
+    log_handler = WatchedFileHandler(LOG_FILE, encoding='utf-8')
+else:
+    log_handler = RotatingFileHandler(
+        LOG_FILE,
+        maxBytes=int(os.environ.get('TALLY_LOG_MAX_BYTES', 5 * 1024 * 1024)),
+        backupCount=int(os.environ.get('TALLY_LOG_BACKUP_COUNT', 5)),
+        encoding='utf-8'
+    )
 logging.basicConfig(
-    filename='tally_extract.log',
-    level=logging.INFO,
+    handlers=[log_handler],
+    level=getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO),
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-class TallyDataExtractor:
+# Tags inspected per LEDGER, in priority order
+BALANCE_TAGS = ('CLOSINGBALANCE', 'CLBALANCE', 'BALANCE', 'AMOUNT', 'BALANCEAMOUNT', 'DRCRBALANCE', 'OPENINGBALANCE', 'LEDGERBALANCE')
+DUE_DATE_TAGS = ('BILLDATE', 'DUEDATE')
+STREAM_CHUNK_SIZE = 64 * 1024
+DEFAULT_LEDGER_GROUPS = "Sundry Debtors,Sundry Creditors"
+# Above this many voucher-touched ledgers a delta run falls back to a full fetch
+DELTA_MAX_LEDGERS = 200
+BACKUP_NAME_FORMAT = "tally_data_%Y%m%d_%H%M%S.db"
+TALLY_DATE_FORMATS = ('%Y%m%d', '%d-%b-%Y', '%d-%b-%y', '%d-%m-%Y', '%d/%m/%Y', '%Y-%m-%d')
+# Voucher children that carry ledger entries (and their BILLALLOCATIONS.LIST)
+VOUCHER_ENTRY_TAGS = ('ALLLEDGERENTRIES.LIST', 'LEDGERENTRIES.LIST')
+CREDIT_PERIOD_RE = re.compile(r'^(\d+)\s*days?$', re.IGNORECASE)
+# A voucher load gives up on a company after this many window requests fail in a row
+VOUCHER_MAX_CONSECUTIVE_FAILURES = 3
+# Scheduled targets falling due within this many seconds of a run are folded into it
+SCHEDULE_COALESCE_SECONDS = 60
+# Longest POST /api/refresh?wait= the API will block for
+REFRESH_MAX_WAIT = 120
+# Multi-tenant deployments: tenant configs, and where tenant databases live unless a tenant sets db_path
+TENANTS_FILE = os.environ.get('TALLY_TENANTS_FILE', 'tenants.json')
+TENANT_DATA_DIR = os.environ.get('TALLY_TENANT_DATA_DIR', 'tenants')
+TENANT_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+# Extractions allowed to run at once across all tenants in a process
+EXTRACTION_SLOTS = threading.BoundedSemaphore(int(os.environ.get('TALLY_MAX_CONCURRENT_EXTRACTIONS', 4)))
+# Concurrent requests allowed to one Tally host across all tenants in a process; Tally is flaky under parallel load
+MAX_REQUESTS_PER_HOST = max(int(os.environ.get('TALLY_MAX_REQUESTS_PER_HOST', 2)), 1)
+# Tally host (netloc) -> (request slots, keep-alive session), shared by every extractor in the process
+TALLY_HOSTS = {}
+TALLY_HOSTS_LOCK = threading.Lock()
+# /api/accounts sort keys -> (column, default order)
+ACCOUNT_SORTS = {
+    'balance': ('closing_balance', 'desc'),
+    'name': ('name', 'asc'),
+    'due_date': ('due_date', 'asc'),
+}
+ACCOUNT_PAGE_DEFAULT = 50
+ACCOUNT_PAGE_MAX = 500
+AGEING_BUCKETS = ('not_due', '0-30', '31-60', '61-90', '90+', 'no_due_date')
+TOP_N_MAX = 50
+HISTORY_RESOLUTIONS = {'hour': 3600, 'day': 86400, 'week': 7 * 86400}
+HISTORY_MAX_POINTS = 500
+STREAM_KEEPALIVE_SECONDS = 25
+STREAM_RETRY_MS = 5000
+DB_WRITE_TIMEOUT = 30
+READ_POOL_SIZE = int(os.environ.get('TALLY_READ_POOL_SIZE', 8))
+# How often each web worker checks whether another process committed new data
+CHANGE_POLL_SECONDS = 5
+EXTRACTOR_LOCK_PATH = "tally_extractor.lock"
+# Change notifications carry the changed accounts only up to this many; larger runs just say "refetch"
+STREAM_DIFF_MAX = 100
+# Metrics served on /api/metrics: name -> (Prometheus type, help)
+METRICS = {
+    'tally_extraction_phase_seconds': ('histogram', 'Duration of extraction phases (fetch, save, total)'),
+    'tally_request_seconds': ('histogram', 'Latency of Tally requests including reading and parsing the response'),
+    'tally_parse_seconds': ('histogram', 'Time spent reading and parsing Tally responses after the headers arrived'),
+    'tally_response_bytes': ('summary', 'Size of Tally response bodies as received'),
+    'tally_request_failures_total': ('counter', 'Tally requests that failed after retries'),
+    'tally_extractions_total': ('counter', 'Extraction runs by outcome'),
+    'tally_accounts': ('gauge', 'Accounts returned by the last extraction'),
+    'tally_last_extraction_timestamp_seconds': ('gauge', 'Unix time the last extraction finished'),
+    'api_request_seconds': ('histogram', 'API request latency up to the response headers, per worker process'),
+    'api_response_bytes': ('summary', 'Size of API response bodies, per worker process'),
+}
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class Metrics:
+    """Thread-safe in-process metrics rendered in the Prometheus text format"""
     def __init__(self):
-        self.tally_url = "http://localhost:9000"
-        self.db_path = "tally_data.db"
-        self.backup_dir = "backups"
+        self.lock = threading.Lock()
+        # name -> {sorted label pairs: number, or {'buckets', 'sum', 'count'}}
+        self.series = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.series.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.setdefault(name, {})
+            state = series.get(key)
+            if state is None:
+                state = series[key] = {'sum': 0, 'count': 0}
+                if METRICS[name][0] == 'histogram':
+                    state['buckets'] = [0] * (len(METRIC_BUCKETS) + 1)
+            state['sum'] += value
+            state['count'] += 1
+            if 'buckets' in state:
+                state['buckets'][bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def has(self, name):
+        with self.lock:
+            return bool(self.series.get(name))
+
+    def snapshot(self, prefix=''):
+        """JSON-serialisable copy of the series whose names start with prefix"""
+        with self.lock:
+            return {name: [[list(key), json.loads(json.dumps(state))] for key, state in series.items()]
+                    for name, series in self.series.items() if name.startswith(prefix)}
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        metrics = cls()
+        for name, series in snapshot.items():
+            if name in METRICS:
+                metrics.series[name] = {tuple(tuple(pair) for pair in key): state for key, state in series}
+        return metrics
+
+    @staticmethod
+    def format_labels(pairs):
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.series):
+                kind, help_text = METRICS[name]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, state in sorted(self.series[name].items()):
+                    labels = self.format_labels(key)
+                    if not isinstance(state, dict):
+                        lines.append(f"{name}{labels} {state}")
+                        continue
+                    if 'buckets' in state:
+                        cumulative = 0
+                        for bound, count in zip(METRIC_BUCKETS + ('+Inf',), state['buckets']):
+                            cumulative += count
+                            lines.append(f"{name}_bucket{self.format_labels(key + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{labels} {state['sum']}")
+                    lines.append(f"{name}_count{labels} {state['count']}")
+        return '\n'.join(lines) + '\n'
+
+class PooledConnection:
+    """Read-only sqlite3 connection whose close() hands it back to the pool"""
+    def __init__(self, conn, pool):
+        self._conn = conn
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        try:
+            self._pool.put_nowait(self._conn)
+        except queue.Full:
+            self._conn.close()
+
+class TallyDataExtractor:
+    def __init__(self, tenant=None):
+        # A tenant config from load_tenants gets its own database, backups, API key and caches
+        tenant = tenant or {}
+        self.tenant_id = tenant.get('id')
+        self.tally_url = tenant.get('tally_url') or "http://localhost:9000"
+        if self.tenant_id:
+            self.db_path = tenant.get('db_path') or os.path.join(TENANT_DATA_DIR, f"{self.tenant_id}.db")
+            self.backup_dir = tenant.get('backup_dir') or os.path.join("backups", self.tenant_id)
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        else:
+            self.db_path = "tally_data.db"
+            self.backup_dir = "backups"
+        self.api_key = tenant.get('api_key') or os.environ.get('API_SECRET_KEY', 'TallyDash2024SecureKey789XYZ')
+        self.last_sync_changes = None
+        self.last_change_event = None
+        self.backup_keep = {
+            'hourly': int(os.environ.get('BACKUP_KEEP_HOURLY', 24)),
+            'daily': int(os.environ.get('BACKUP_KEEP_DAILY', 7)),
+            'weekly': int(os.environ.get('BACKUP_KEEP_WEEKLY', 4)),
+        }
+        self.backup_lock = threading.Lock()
+        # Snapshots older than this many days are compacted to one delta per ledger per day
+        self.history_daily_after_days = int(os.environ.get('HISTORY_DAILY_AFTER_DAYS', 90))
+        # Pre-serialised /api/dashboard-data response, swapped atomically after each save
+        self.dashboard_cache = None
+        self.dashboard_cache_lock = threading.Lock()
+        # Latest change notification for /api/stream subscribers, guarded by change_condition
+        self.change_condition = threading.Condition()
+        self.change_seq = 0
+        self.change_event = None
+        self.read_pool = None
+        self.read_pool_pid = None
+        self.streaming_parser = os.environ.get('TALLY_STREAMING_PARSER', '1') != '0'
+        self.ledger_groups = tenant.get('groups') or [g.strip() for g in os.environ.get('TALLY_GROUPS', DEFAULT_LEDGER_GROUPS).split(',') if g.strip()]
+        # Each company entry: {"name": "...", "url": "http://host:9000", "groups": [...]}; name/url/groups optional
+        if self.tenant_id:
+            self.tally_companies = tenant.get('companies') or [{'name': tenant.get('company')}]
+        else:
+            self.tally_companies = json.loads(os.environ.get('TALLY_COMPANIES', 'null')) or [{'name': None}]
+        self.max_requests_per_host = MAX_REQUESTS_PER_HOST
+        self.fetch_retries = int(os.environ.get('TALLY_FETCH_RETRIES', 3))
+        self.fetch_backoff = float(os.environ.get('TALLY_FETCH_BACKOFF', 1.0))
+        # Fetch only ledgers altered since the last run (ALTERID watermarks), with a periodic full reconcile
+        self.incremental_extraction = os.environ.get('TALLY_INCREMENTAL', '0') == '1'
+        self.full_reconcile_hours = float(os.environ.get('TALLY_FULL_RECONCILE_HOURS', 24))
+        # Days of vouchers requested per Tally call by extract_vouchers
+        self.voucher_window_days = max(1, int(os.environ.get('TALLY_VOUCHER_WINDOW_DAYS', 7)))
+        # Set by run_scheduler when this process runs extractions, so refresh requests can wake it directly
+        self.scheduler = None
+        # Write every Tally response to tally_response_<label>.xml for troubleshooting
+        self.debug_xml = os.environ.get('TALLY_DEBUG_XML', '0') == '1'
+        self.metrics = Metrics()
+        # Hosts whose last request failed to connect, cleared by the next success
+        self.unreachable_hosts = set()
         self.setup_database()
         self.setup_api_server()
         
@@ -32,8 +280,12 @@ class TallyDataExtractor:
         try:
             if not os.path.exists(self.backup_dir):
                 os.makedirs(self.backup_dir)
-            conn = sqlite3.connect(self.db_path)
+            conn = sqlite3.connect(self.db_path, timeout=DB_WRITE_TIMEOUT)
+            # WAL lets API readers keep reading the last committed snapshot while a save is in progress
+            conn.execute('PRAGMA journal_mode=WAL')
             cursor = conn.cursor()
+            # Serialise migrations when several gunicorn workers start at once
+            cursor.execute('BEGIN IMMEDIATE')
             cursor.execute('PRAGMA table_info(accounts)')
             columns = [row[1] for row in cursor.fetchall()]
             if 'accounts' not in [table[0] for table in cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")] or 'due_date' not in columns:
@@ -50,6 +302,11 @@ class TallyDataExtractor:
                     )
                 ''')
                 logging.info("Recreated accounts table with due_date column")
+            self.migrate_accounts_sync(cursor)
+            self.create_account_indexes(cursor)
+            self.refresh_account_summary(cursor)
+            self.create_history_tables(cursor)
+            self.create_voucher_tables(cursor)
             conn.commit()
             logging.info("Database setup complete")
         except sqlite3.Error as e:
@@ -57,26 +314,295 @@ class TallyDataExtractor:
         finally:
             conn.close()
 
+    def migrate_accounts_sync(self, cursor):
+        """Add the unique ledger key, change tracking column and sync_state table used by incremental saves"""
+        cursor.execute('PRAGMA table_info(accounts)')
+        columns = [row[1] for row in cursor.fetchall()]
+        if 'changed_at' not in columns:
+            cursor.execute('ALTER TABLE accounts ADD COLUMN changed_at TIMESTAMP')
+            cursor.execute('UPDATE accounts SET changed_at = last_updated')
+            logging.info("Added changed_at column to accounts table")
+        if 'company' not in columns:
+            # Single-company installs store '' so the ledger key stays NOT NULL
+            cursor.execute("ALTER TABLE accounts ADD COLUMN company TEXT NOT NULL DEFAULT ''")
+            logging.info("Added company column to accounts table")
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_accounts_company_key'")
+        if cursor.fetchone() is None:
+            # Older full-rewrite saves never enforced uniqueness; keep the newest copy of each ledger
+            cursor.execute('''
+                DELETE FROM accounts WHERE id NOT IN (
+                    SELECT MAX(id) FROM accounts GROUP BY name, type, IFNULL(parent_group, ''), company
+                )
+            ''')
+            # The old key and covering indexes predate the company column; create_account_indexes rebuilds the latter
+            cursor.execute('DROP INDEX IF EXISTS idx_accounts_ledger_key')
+            for sort_key in ACCOUNT_SORTS:
+                cursor.execute(f'DROP INDEX IF EXISTS idx_accounts_type_{sort_key}')
+            cursor.execute('CREATE UNIQUE INDEX idx_accounts_company_key ON accounts (name, type, parent_group, company)')
+            logging.info("Created unique ledger key index on accounts")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sync_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+
+    def create_account_indexes(self, cursor):
+        """Covering indexes so each /api/accounts page is an index range scan"""
+        page_columns = ('name', 'closing_balance', 'due_date', 'parent_group', 'company', 'last_updated')
+        for sort_key, (column, _) in ACCOUNT_SORTS.items():
+            covered = ', '.join(c for c in page_columns if c != column)
+            cursor.execute(f'''
+                CREATE INDEX IF NOT EXISTS idx_accounts_type_{sort_key}
+                ON accounts (type, {column}, id, {covered})
+            ''')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_accounts_{sort_key} ON accounts ({column}, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_accounts_parent_balance ON accounts (parent_group, closing_balance, id)')
+
+    def refresh_account_summary(self, cursor):
+        """Recompute ageing buckets, per-group and per-type totals into account_summary"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS account_summary (
+                kind TEXT NOT NULL,
+                type TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                total REAL NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (kind, type, bucket)
+            )
+        ''')
+        cursor.execute('DELETE FROM account_summary')
+        cursor.execute('''
+            INSERT INTO account_summary (kind, type, bucket, total, count)
+            SELECT 'ageing', type, bucket, SUM(closing_balance), COUNT(*)
+            FROM (
+                SELECT type, closing_balance,
+                    CASE
+                        WHEN julianday(due_date) IS NULL THEN 'no_due_date'
+                        WHEN julianday(:today) - julianday(due_date) < 0 THEN 'not_due'
+                        WHEN julianday(:today) - julianday(due_date) <= 30 THEN '0-30'
+                        WHEN julianday(:today) - julianday(due_date) <= 60 THEN '31-60'
+                        WHEN julianday(:today) - julianday(due_date) <= 90 THEN '61-90'
+                        ELSE '90+'
+                    END AS bucket
+                FROM accounts
+            )
+            GROUP BY type, bucket
+        ''', {'today': datetime.now().strftime('%Y-%m-%d')})
+        cursor.execute('''
+            INSERT INTO account_summary (kind, type, bucket, total, count)
+            SELECT 'group', type, IFNULL(parent_group, ''), SUM(closing_balance), COUNT(*)
+            FROM accounts
+            GROUP BY type, IFNULL(parent_group, '')
+        ''')
+        cursor.execute('''
+            INSERT INTO account_summary (kind, type, bucket, total, count)
+            SELECT 'total', type, '', SUM(closing_balance), COUNT(*)
+            FROM accounts
+            GROUP BY type
+        ''')
+        cursor.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES ('summary_refreshed', ?)", (datetime.now().isoformat(),))
+
+    def create_history_tables(self, cursor):
+        """Append-only run log plus per-ledger and per-group balance deltas"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS extraction_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at TIMESTAMP NOT NULL,
+                finished_at TIMESTAMP NOT NULL,
+                account_count INTEGER NOT NULL,
+                changed_count INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_runs_started ON extraction_runs (started_at)')
+        cursor.execute('PRAGMA table_info(balance_snapshots)')
+        columns = [row[1] for row in cursor.fetchall()]
+        if columns and 'company' not in columns:
+            # The company is part of the primary key, so the table has to be rebuilt
+            cursor.execute('ALTER TABLE balance_snapshots RENAME TO balance_snapshots_old')
+        # A row is only written when a balance differs from its previous snapshot
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS balance_snapshots (
+                name TEXT NOT NULL,
+                type TEXT NOT NULL,
+                parent_group TEXT NOT NULL,
+                company TEXT NOT NULL,
+                run_id INTEGER NOT NULL,
+                balance REAL NOT NULL,
+                PRIMARY KEY (name, type, parent_group, company, run_id)
+            ) WITHOUT ROWID
+        ''')
+        if columns and 'company' not in columns:
+            cursor.execute('''
+                INSERT INTO balance_snapshots (name, type, parent_group, company, run_id, balance)
+                SELECT name, type, parent_group, '', run_id, balance FROM balance_snapshots_old
+            ''')
+            cursor.execute('DROP TABLE balance_snapshots_old')
+            logging.info("Added company to balance_snapshots key")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS group_snapshots (
+                type TEXT NOT NULL,
+                parent_group TEXT NOT NULL,
+                run_id INTEGER NOT NULL,
+                total REAL NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (type, parent_group, run_id)
+            ) WITHOUT ROWID
+        ''')
+
+    def create_voucher_tables(self, cursor):
+        """Vouchers and their bill allocations, loaded one date window at a time by extract_vouchers"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS vouchers (
+                company TEXT NOT NULL,
+                guid TEXT NOT NULL,
+                date TEXT NOT NULL,
+                voucher_type TEXT,
+                voucher_number TEXT,
+                party_ledger TEXT,
+                alter_id INTEGER,
+                synced_at TIMESTAMP NOT NULL,
+                amount REAL,
+                PRIMARY KEY (company, guid)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_vouchers_date ON vouchers (company, date)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_vouchers_party ON vouchers (party_ledger, date)')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bills (
+                company TEXT NOT NULL,
+                voucher_guid TEXT NOT NULL,
+                date TEXT NOT NULL,
+                ledger_name TEXT NOT NULL,
+                bill_name TEXT NOT NULL,
+                bill_type TEXT,
+                due_date TEXT,
+                amount REAL NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_bills_voucher ON bills (company, voucher_guid)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_bills_date ON bills (company, date)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_bills_ledger ON bills (company, ledger_name, bill_name)')
+        # Allocations netted per bill reference; amounts keep Tally's sign (negative is debit).
+        # Only bills raised in the loaded range (those with a New Ref) are reported: an Agst Ref
+        # settling an older bill would otherwise show up as outstanding. Opening bills from
+        # ledger masters are not loaded yet.
+        cursor.execute('DROP VIEW IF EXISTS bill_outstanding')
+        cursor.execute('''
+            CREATE VIEW bill_outstanding AS
+            SELECT company, ledger_name, bill_name,
+                   MIN(date) AS bill_date,
+                   MIN(CASE WHEN bill_type = 'New Ref' THEN due_date END) AS due_date,
+                   ROUND(SUM(amount), 2) AS outstanding
+            FROM bills
+            GROUP BY company, ledger_name, bill_name
+            HAVING ABS(SUM(amount)) > 0.01 AND MAX(bill_type = 'New Ref') = 1
+        ''')
+
+    def record_history(self, cursor, started_at, finished_at, incoming, changes):
+        """Log an extraction run and write balance deltas for changed ledgers and groups"""
+        changed_count = sum(len(keys) for keys in changes.values())
+        cursor.execute('''
+            INSERT INTO extraction_runs (started_at, finished_at, account_count, changed_count)
+            VALUES (?, ?, ?, ?)
+        ''', (started_at, finished_at, len(incoming), changed_count))
+        run_id = cursor.lastrowid
+        if not changed_count:
+            return run_id
+        
+        snapshots = [(name, acc_type, parent or '', company, run_id, incoming[(name, acc_type, parent, company)]['balance'])
+                     for name, acc_type, parent, company in changes['inserted'] + changes['updated']]
+        snapshots += [(name, acc_type, parent or '', company, run_id, 0.0) for name, acc_type, parent, company in changes['deleted']]
+        cursor.executemany('INSERT INTO balance_snapshots VALUES (?, ?, ?, ?, ?, ?)', snapshots)
+        
+        previous = {(row[0], row[1]): (row[2], row[3]) for row in cursor.execute('''
+            SELECT type, parent_group, total, count FROM group_snapshots g
+            WHERE run_id = (SELECT MAX(run_id) FROM group_snapshots WHERE type = g.type AND parent_group = g.parent_group)
+        ''')}
+        current = {(row[0], row[1]): (row[2], row[3]) for row in cursor.execute(
+            "SELECT type, bucket, total, count FROM account_summary WHERE kind = 'group'")}
+        group_deltas = [(key[0], key[1], run_id) + value for key, value in current.items() if previous.get(key) != value]
+        group_deltas += [(key[0], key[1], run_id, 0.0, 0) for key, value in previous.items()
+                         if key not in current and value != (0.0, 0)]
+        cursor.executemany('INSERT INTO group_snapshots VALUES (?, ?, ?, ?, ?)', group_deltas)
+        return run_id
+
+    def rollup_history(self, cursor):
+        """Compact snapshots older than history_daily_after_days to the last delta of each day, once per day"""
+        today = datetime.now().strftime('%Y-%m-%d')
+        row = cursor.execute("SELECT value FROM sync_state WHERE key = 'history_rollup'").fetchone()
+        last_day, last_run = (row[0].split('|') if row else ('', '0'))
+        if last_day == today:
+            return
+        cutoff = (datetime.now() - timedelta(days=self.history_daily_after_days)).strftime('%Y-%m-%d')
+        cutoff_run = cursor.execute('SELECT MAX(id) FROM extraction_runs WHERE started_at < ?', (cutoff,)).fetchone()[0] or 0
+        if cutoff_run > int(last_run):
+            for table, key_columns in (('balance_snapshots', ('name', 'type', 'parent_group', 'company')),
+                                       ('group_snapshots', ('type', 'parent_group'))):
+                same_key = ' AND '.join(f't.{col} = s.{col}' for col in key_columns)
+                # Runs up to last_run were compacted by an earlier rollup
+                cursor.execute(f'''
+                    DELETE FROM {table} AS s
+                    WHERE s.run_id > :low AND s.run_id <= :high AND EXISTS (
+                        SELECT 1 FROM {table} t JOIN extraction_runs rt ON rt.id = t.run_id
+                        WHERE {same_key} AND t.run_id > s.run_id AND t.run_id <= :high
+                          AND date(rt.started_at) = (SELECT date(started_at) FROM extraction_runs WHERE id = s.run_id)
+                    )
+                ''', {'low': int(last_run), 'high': cutoff_run})
+            logging.info(f"Rolled up history snapshots up to run {cutoff_run}")
+        cursor.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES ('history_rollup', ?)",
+                       (f"{today}|{max(cutoff_run, int(last_run))}",))
+
     def setup_api_server(self):
         """Setup Flask API server for serving data"""
         self.app = Flask(__name__)
         # Updated CORS to allow your domain and fallback to wildcard
         CORS(self.app, resources={r"/api/*": {"origins": ["https://m.yourdomain.com", "*"]}}, supports_credentials=True)
         
-        API_SECRET_KEY = os.environ.get('API_SECRET_KEY', 'TallyDash2024SecureKey789XYZ')
-        logging.info(f"API server using key: {API_SECRET_KEY}")
-        
         def verify_api_key(f):
             @wraps(f)
             def decorated_function(*args, **kwargs):
-                logging.info(f"All headers: {dict(request.headers)}")
                 api_key = request.headers.get('X-API-Key')
-                logging.info(f"Received API key: {api_key}")
-                if not api_key or api_key != API_SECRET_KEY:
+                if not api_key and request.path == '/api/stream':
+                    # EventSource cannot send custom headers
+                    api_key = request.args.get('api_key')
+                if not api_key or api_key != self.api_key:
+                    logging.warning(f"Rejected API request to {request.path} from {request.remote_addr}")
                     return jsonify({'error': 'Invalid API key'}), 401
                 return f(*args, **kwargs)
             return decorated_function
 
+        @self.app.before_request
+        def start_request_timer():
+            g.request_started = time.perf_counter()
+
+        @self.app.after_request
+        def record_request_metrics(response):
+            started = g.pop('request_started', None)
+            # Event streams stay open; their duration and size say nothing about latency
+            if started is None or response.mimetype == 'text/event-stream':
+                return response
+            endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+            # Each gunicorn worker keeps its own series; the worker label stops scrapes that land on
+            # different workers from looking like counter resets (sum by endpoint to aggregate)
+            worker = os.getpid()
+            self.metrics.observe('api_request_seconds', time.perf_counter() - started,
+                                 endpoint=endpoint, method=request.method, status=response.status_code, worker=worker)
+            size = response.calculate_content_length()
+            if size is not None:
+                self.metrics.observe('api_response_bytes', size, endpoint=endpoint, worker=worker)
+            return response
+
+        @self.app.route('/api/metrics', methods=['GET'])
+        def get_metrics():
+            body = self.metrics.render()
+            if not self.metrics.has('tally_extractions_total'):
+                # Extraction runs in another process; serve the figures it last stored
+                stored = self.get_sync_state('extraction_metrics')
+                if stored:
+                    body += Metrics.from_snapshot(stored).render()
+            return Response(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
         @self.app.route('/api/health', methods=['GET'])
         def health_check():
             return jsonify({
@@ -88,58 +614,597 @@ class TallyDataExtractor:
         @self.app.route('/api/dashboard-data', methods=['GET'])
         @verify_api_key
         def get_dashboard_data():
+            cached = self.dashboard_cache
+            if not cached or not self.dashboard_cache_current(cached):
+                cached = self.rebuild_dashboard_cache()
+            if cached is None:
+                return jsonify({'error': 'Database query failed'}), 500
+            return self.cached_response(cached)
+
+        @self.app.route('/api/stream', methods=['GET'])
+        @verify_api_key
+        def stream_changes():
+            try:
+                last_seen = int(request.headers.get('Last-Event-ID') or request.args.get('since') or -1)
+            except ValueError:
+                last_seen = -1
+            response = Response(stream_with_context(self.change_stream(last_seen)), mimetype='text/event-stream')
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['X-Accel-Buffering'] = 'no'
+            return response
+
+        @self.app.route('/api/accounts', methods=['GET'])
+        @verify_api_key
+        def get_accounts():
+            try:
+                query, params, sort_key, order, limit = self.build_accounts_query(request.args)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            
             conn = self.get_db_connection()
             if not conn:
                 return jsonify({'error': 'Database connection failed'}), 500
             
             try:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT name, type, closing_balance, due_date, parent_group, last_updated
-                    FROM accounts 
+                column = ACCOUNT_SORTS[sort_key][0]
+                rows = [dict(row) for row in conn.execute(query, params).fetchall()]
+                next_cursor = None
+                if len(rows) > limit:
+                    rows = rows[:limit]
+                    last = rows[-1]
+                    next_cursor = self.encode_cursor(sort_key, order, last[column], last['id'])
+                return jsonify({
+                    'accounts': rows,
+                    'count': len(rows),
+                    'sort': sort_key,
+                    'order': order,
+                    'next_cursor': next_cursor
+                })
+            except sqlite3.Error as e:
+                logging.error(f"Database query error: {e}")
+                return jsonify({'error': 'Database query failed'}), 500
+            finally:
+                conn.close()
+
+        @self.app.route('/api/summary/ageing', methods=['GET'])
+        @verify_api_key
+        def get_ageing_summary():
+            return self.summary_response('ageing', request.args.get('type', 'debtor'))
+
+        @self.app.route('/api/summary/groups', methods=['GET'])
+        @verify_api_key
+        def get_group_summary():
+            return self.summary_response('group', request.args.get('type'))
+
+        @self.app.route('/api/summary/totals', methods=['GET'])
+        @verify_api_key
+        def get_totals_summary():
+            return self.summary_response('total', None)
+
+        @self.app.route('/api/summary/top', methods=['GET'])
+        @verify_api_key
+        def get_top_accounts():
+            try:
+                n = min(max(int(request.args.get('n', 10)), 1), TOP_N_MAX)
+            except ValueError:
+                return jsonify({'error': 'n must be numeric'}), 400
+            conn = self.get_db_connection()
+            if not conn:
+                return jsonify({'error': 'Database connection failed'}), 500
+            try:
+                # Walks idx_accounts_type_balance backwards, so cost is O(n) regardless of ledger count
+                rows = conn.execute('''
+                    SELECT name, closing_balance, parent_group, company, due_date
+                    FROM accounts
+                    WHERE type = ?
                     ORDER BY closing_balance DESC
-                ''')
-                accounts = [dict(row) for row in cursor.fetchall()]
-                
-                total_debtors = sum(acc['closing_balance'] for acc in accounts if acc['type'] == 'debtor')
-                total_creditors = sum(acc['closing_balance'] for acc in accounts if acc['type'] == 'creditor')
-                
-                cursor.execute('SELECT MAX(last_updated) as last_update FROM accounts')
-                last_update_row = cursor.fetchone()
-                last_update = last_update_row['last_update'] if last_update_row else None
-                
-                debtors = [acc for acc in accounts if acc['type'] == 'debtor']
-                creditors = [acc for acc in accounts if acc['type'] == 'creditor']
-                
-                response_data = {
-                    'summary': {
-                        'total_debtors': total_debtors,
-                        'total_creditors': total_creditors,
-                        'net_position': total_debtors - total_creditors,
-                        'total_accounts': len(accounts),
-                        'debtors_count': len(debtors),
-                        'creditors_count': len(creditors),
-                        'last_updated': last_update
-                    },
-                    'debtors': debtors,
-                    'creditors': creditors,
-                    'timestamp': datetime.now().isoformat()
-                }
-                
-                return jsonify(response_data)
-                
+                    LIMIT ?
+                ''', (request.args.get('type', 'debtor'), n)).fetchall()
+                return jsonify({'type': request.args.get('type', 'debtor'), 'accounts': [dict(row) for row in rows]})
+            except sqlite3.Error as e:
+                logging.error(f"Database query error: {e}")
+                return jsonify({'error': 'Database query failed'}), 500
+            finally:
+                conn.close()
+
+        @self.app.route('/api/history', methods=['GET'])
+        @verify_api_key
+        def get_history():
+            args = request.args
+            scope = args.get('scope', 'totals')
+            try:
+                end = datetime.fromisoformat(args['to']) if 'to' in args else datetime.now()
+                start = datetime.fromisoformat(args['from']) if 'from' in args else end - timedelta(days=30)
+            except ValueError:
+                return jsonify({'error': 'from/to must be ISO dates'}), 400
+            # Runs are stored in naive local time; an explicit offset is converted to it
+            start, end = (value.astimezone().replace(tzinfo=None) if value.tzinfo else value for value in (start, end))
+            if start >= end:
+                return jsonify({'error': 'from must be before to'}), 400
+            resolution = args.get('resolution') or next(
+                (res for res, step in HISTORY_RESOLUTIONS.items() if (end - start).total_seconds() / step <= HISTORY_MAX_POINTS), 'week')
+            if resolution not in HISTORY_RESOLUTIONS:
+                return jsonify({'error': f"resolution must be one of: {', '.join(HISTORY_RESOLUTIONS)}"}), 400
+            if (end - start).total_seconds() / HISTORY_RESOLUTIONS[resolution] > HISTORY_MAX_POINTS:
+                return jsonify({'error': f"from/to spans more than {HISTORY_MAX_POINTS} points at resolution={resolution}; "
+                                         f"use a coarser resolution or a shorter range"}), 400
+            account_type = args.get('type', 'debtor')
+            if scope == 'ledger':
+                if not args.get('name'):
+                    return jsonify({'error': 'name is required for scope=ledger'}), 400
+                table, value_column, series_columns = 'balance_snapshots', 'balance', ('parent_group', 'company')
+                filters = {'name': args['name'], 'type': account_type}
+                for column in ('parent_group', 'company'):
+                    if args.get(column):
+                        filters[column] = args[column]
+            elif scope == 'group':
+                if not args.get('parent_group'):
+                    return jsonify({'error': 'parent_group is required for scope=group'}), 400
+                table, value_column, series_columns = 'group_snapshots', 'total', ('type',)
+                filters = {'parent_group': args['parent_group']}
+                if args.get('type'):
+                    filters['type'] = args['type']
+            elif scope == 'totals':
+                table, value_column, series_columns = 'group_snapshots', 'total', ('parent_group',)
+                filters = {'type': account_type}
+            else:
+                return jsonify({'error': 'scope must be ledger, group or totals'}), 400
+            
+            conn = self.get_db_connection()
+            if not conn:
+                return jsonify({'error': 'Database connection failed'}), 500
+            try:
+                points = self.history_series(conn, table, value_column, series_columns, filters,
+                                             start, end, HISTORY_RESOLUTIONS[resolution])
+            except sqlite3.Error as e:
+                logging.error(f"Database query error: {e}")
+                return jsonify({'error': 'Database query failed'}), 500
+            finally:
+                conn.close()
+            return jsonify({
+                'scope': scope,
+                'filters': filters,
+                'resolution': resolution,
+                'from': start.isoformat(),
+                'to': end.isoformat(),
+                'points': points
+            })
+
+        @self.app.route('/api/refresh', methods=['POST'])
+        @verify_api_key
+        def refresh():
+            """Queue an extraction of everything; ?wait=N blocks up to N seconds for it to finish"""
+            try:
+                wait = min(max(float(request.args.get('wait', 0)), 0), REFRESH_MAX_WAIT)
+            except ValueError:
+                return jsonify({'error': 'wait must be a number of seconds'}), 400
+            request_id = self.request_refresh()
+            if request_id is None:
+                return jsonify({'error': 'Could not queue refresh'}), 500
+            status = self.wait_for_refresh(request_id, wait)
+            done = bool(status) and status.get('served_request', 0) >= request_id and status.get('state') == 'idle'
+            return jsonify({'request_id': request_id, 'done': done, 'scheduler': status}), 200 if done else 202
+
+        @self.app.route('/api/refresh', methods=['GET'])
+        @verify_api_key
+        def refresh_status():
+            return jsonify({'scheduler': self.get_sync_state('scheduler_status')})
+
+        @self.app.route('/api/bills', methods=['GET'])
+        @verify_api_key
+        def get_bills():
+            """Outstanding bills, earliest due first; ?overdue=1 keeps bills past their due date"""
+            args = request.args
+            try:
+                limit = min(max(int(args.get('limit', ACCOUNT_PAGE_DEFAULT)), 1), ACCOUNT_PAGE_MAX)
+            except ValueError:
+                return jsonify({'error': 'limit must be an integer'}), 400
+            today = datetime.now().strftime('%Y-%m-%d')
+            clauses, params = [], []
+            for column in ('company', 'ledger_name'):
+                if args.get(column):
+                    clauses.append(f'{column} = ?')
+                    params.append(args[column])
+            if args.get('overdue') == '1':
+                clauses.append('due_date < ?')
+                params.append(today)
+            where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+            
+            conn = self.get_db_connection()
+            if not conn:
+                return jsonify({'error': 'Database connection failed'}), 500
+            try:
+                rows = conn.execute(f'''
+                    SELECT company, ledger_name, bill_name, bill_date, due_date, outstanding
+                    FROM bill_outstanding {where}
+                    ORDER BY due_date IS NULL, due_date, bill_date
+                    LIMIT ?
+                ''', params + [limit]).fetchall()
             except sqlite3.Error as e:
                 logging.error(f"Database query error: {e}")
                 return jsonify({'error': 'Database query failed'}), 500
             finally:
                 conn.close()
+            return jsonify({
+                'as_of': today,
+                'bills': [{
+                    'company': company,
+                    'ledger': ledger,
+                    'bill': bill,
+                    'bill_date': bill_date,
+                    'due_date': due_date,
+                    'outstanding': outstanding,
+                    'days_overdue': max((datetime.now() - datetime.fromisoformat(due_date)).days, 0) if due_date else None
+                } for company, ledger, bill, bill_date, due_date, outstanding in rows]
+            })
+
+    def summary_response(self, kind, account_type):
+        """Serve rows of the precomputed account_summary table"""
+        conn = self.get_db_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'}), 500
+        try:
+            query = 'SELECT type, bucket, total, count FROM account_summary WHERE kind = ?'
+            params = [kind]
+            if account_type:
+                query += ' AND type = ?'
+                params.append(account_type)
+            rows = conn.execute(query, params).fetchall()
+            as_of = conn.execute("SELECT value FROM sync_state WHERE key = 'summary_refreshed'").fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"Database query error: {e}")
+            return jsonify({'error': 'Database query failed'}), 500
+        finally:
+            conn.close()
+        
+        if kind == 'ageing':
+            found = {row['bucket']: row for row in rows}
+            buckets = [{
+                'bucket': bucket,
+                'total': found[bucket]['total'] if bucket in found else 0.0,
+                'count': found[bucket]['count'] if bucket in found else 0
+            } for bucket in AGEING_BUCKETS]
+        else:
+            buckets = sorted(({'type': row['type'], 'bucket': row['bucket'], 'total': row['total'], 'count': row['count']}
+                              for row in rows), key=lambda b: -b['total'])
+        return jsonify({
+            'kind': kind,
+            'type': account_type,
+            'buckets': buckets,
+            'as_of': as_of['value'] if as_of else None
+        })
+
+    def history_series(self, conn, table, value_column, series_columns, filters, start, end, step):
+        """Downsample balance deltas into [bucket_start, value] points, summing the latest value per series_columns"""
+        series = ', '.join(f's.{col}' for col in series_columns)
+        same_series = ' AND '.join(f't.{col} = s.{col}' for col in series_columns)
+        where = ' AND '.join(f's.{col} = :{col}' for col in filters)
+        inner_where = ' AND '.join(f't.{col} = :{col}' for col in filters)
+        params = dict(filters)
+        # Runs are numbered in start order, so the window is bounded by the last run before each end
+        params['carry_run'], params['last_run'] = conn.execute('''
+            SELECT IFNULL(MAX(CASE WHEN started_at < :start THEN id END), 0), IFNULL(MAX(id), 0)
+            FROM extraction_runs WHERE started_at <= :end
+        ''', {'start': start.isoformat(), 'end': end.isoformat()}).fetchone()
+        
+        # Value carried into the window: the latest delta of each series up to the last run before start
+        latest = {tuple(row[:-1]): row[-1] for row in conn.execute(f'''
+            SELECT {series}, s.{value_column} FROM {table} s
+            WHERE {where} AND s.run_id = (
+                SELECT MAX(t.run_id) FROM {table} t
+                WHERE {inner_where} AND {same_series} AND t.run_id <= :carry_run
+            )
+        ''', params)}
+        deltas = conn.execute(f'''
+            SELECT r.started_at, s.{value_column}, {series} FROM {table} s
+            JOIN extraction_runs r ON r.id = s.run_id
+            WHERE {where} AND s.run_id > :carry_run AND s.run_id <= :last_run
+            ORDER BY s.run_id
+        ''', params).fetchall()
+        
+        origin = start.replace(minute=0, second=0, microsecond=0)
+        if step >= HISTORY_RESOLUTIONS['day']:
+            origin = origin.replace(hour=0)
+        if step >= HISTORY_RESOLUTIONS['week']:
+            origin -= timedelta(days=origin.weekday())
+        points = []
+        bucket_end = origin + timedelta(seconds=step)
+        idx = 0
+        while origin <= end:
+            while idx < len(deltas) and datetime.fromisoformat(deltas[idx][0]) < bucket_end:
+                latest[tuple(deltas[idx][2:])] = deltas[idx][1]
+                idx += 1
+            points.append([origin.isoformat(), round(sum(latest.values()), 2) if latest else None])
+            origin = bucket_end
+            bucket_end = origin + timedelta(seconds=step)
+        return points
+
+    def encode_cursor(self, sort_key, order, value, row_id):
+        raw = json.dumps([sort_key, order, value, row_id], separators=(',', ':')).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+    def decode_cursor(self, cursor, sort_key, order):
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            cursor_sort, cursor_order, value, row_id = json.loads(raw)
+        except (ValueError, TypeError):
+            raise ValueError("Invalid cursor")
+        if (cursor_sort, cursor_order) != (sort_key, order) or not isinstance(row_id, int):
+            raise ValueError("Cursor does not match sort/order")
+        return value, row_id
+
+    def build_accounts_query(self, args):
+        """Translate /api/accounts query parameters into a keyset-paginated SELECT.
+
+        Filters: type, parent_group, company, min_balance, max_balance, due_from, due_to
+        (ISO dates) and name_prefix (case-sensitive). Sorting: sort=balance|name|
+        due_date with order=asc|desc, paged with limit and the opaque cursor
+        returned as next_cursor. Returns (sql, params, sort_key, order, limit);
+        the query fetches limit + 1 rows so the caller can tell whether another
+        page exists.
+        """
+        sort_key = args.get('sort', 'balance')
+        if sort_key not in ACCOUNT_SORTS:
+            raise ValueError(f"sort must be one of: {', '.join(ACCOUNT_SORTS)}")
+        column, default_order = ACCOUNT_SORTS[sort_key]
+        order = args.get('order', default_order).lower()
+        if order not in ('asc', 'desc'):
+            raise ValueError("order must be asc or desc")
+        try:
+            limit = min(max(int(args.get('limit', ACCOUNT_PAGE_DEFAULT)), 1), ACCOUNT_PAGE_MAX)
+            min_balance = float(args['min_balance']) if 'min_balance' in args else None
+            max_balance = float(args['max_balance']) if 'max_balance' in args else None
+        except ValueError:
+            raise ValueError("limit, min_balance and max_balance must be numeric")
+        
+        where = []
+        params = []
+        if args.get('type'):
+            where.append('type = ?')
+            params.append(args['type'])
+        if args.get('parent_group'):
+            where.append('parent_group = ?')
+            params.append(args['parent_group'])
+        if 'company' in args:
+            where.append('company = ?')
+            params.append(args['company'])
+        if min_balance is not None:
+            where.append('closing_balance >= ?')
+            params.append(min_balance)
+        if max_balance is not None:
+            where.append('closing_balance <= ?')
+            params.append(max_balance)
+        if args.get('due_from'):
+            where.append("due_date >= ? AND due_date != ''")
+            params.append(args['due_from'])
+        if args.get('due_to'):
+            where.append("due_date <= ? AND due_date != ''")
+            params.append(args['due_to'])
+        prefix = args.get('name_prefix')
+        if prefix:
+            # Half-open range on the prefix keeps this an index range instead of a LIKE scan
+            where.append('name >= ? AND name < ?')
+            params.extend([prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)])
+        if args.get('cursor'):
+            value, row_id = self.decode_cursor(args['cursor'], sort_key, order)
+            where.append(f"({column}, id) {'<' if order == 'desc' else '>'} (?, ?)")
+            params.extend([value, row_id])
+        
+        direction = order.upper()
+        query = f'''
+            SELECT id, name, type, closing_balance, due_date, parent_group, company, last_updated
+            FROM accounts
+            {'WHERE ' + ' AND '.join(where) if where else ''}
+            ORDER BY {column} {direction}, id {direction}
+            LIMIT ?
+        '''
+        params.append(limit + 1)
+        return query, params, sort_key, order, limit
+
+    def build_change_event(self, run_id, synced_at, changes, incoming):
+        """Compact description of a save for /api/stream, with the changed rows when there are few"""
+        counts = {kind: len(keys) for kind, keys in changes.items()}
+        event = {
+            'run_id': run_id,
+            'last_sync': synced_at,
+            'counts': counts,
+        }
+        if sum(counts.values()) <= STREAM_DIFF_MAX:
+            event['changed'] = [
+                {'name': key[0], 'type': key[1], 'parent_group': key[2], 'company': key[3],
+                 'closing_balance': incoming[key]['balance'], 'due_date': incoming[key]['due_date']}
+                for key in changes['inserted'] + changes['updated']
+            ]
+            event['deleted'] = [{'name': key[0], 'type': key[1], 'parent_group': key[2], 'company': key[3]}
+                                for key in changes['deleted']]
+        return event
+
+    def publish_change(self, event, notify=True):
+        """Wake every /api/stream subscriber; events are identified by run id so each is sent once per process"""
+        with self.change_condition:
+            if event['run_id'] <= self.change_seq:
+                return
+            event = dict(event, etag=self.dashboard_cache['etag'] if self.dashboard_cache else None)
+            self.change_seq = event['run_id']
+            self.change_event = json.dumps(event, separators=(',', ':'))
+            if notify:
+                self.change_condition.notify_all()
+
+    def start_change_watcher(self):
+        """Rebuild the cache and publish stream events when another process commits a save"""
+        def read_last_change(conn):
+            row = conn.execute("SELECT value FROM sync_state WHERE key = 'last_change'").fetchone()
+            return json.loads(row[0]) if row else None
+
+        def watch():
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+            try:
+                event = read_last_change(conn)
+                if event:
+                    self.publish_change(event, notify=False)
+                data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+                while True:
+                    time.sleep(CHANGE_POLL_SECONDS)
+                    try:
+                        current = conn.execute('PRAGMA data_version').fetchone()[0]
+                        if current == data_version:
+                            continue
+                        data_version = current
+                        event = read_last_change(conn)
+                        if event and event['run_id'] > self.change_seq:
+                            self.rebuild_dashboard_cache()
+                            self.publish_change(event)
+                        elif self.dashboard_cache and self.read_last_sync(conn) not in (None, self.dashboard_cache['last_sync']):
+                            # A run without changes still moves last_updated, and with it the ETag
+                            self.rebuild_dashboard_cache()
+                    except sqlite3.Error as e:
+                        logging.error(f"Change watcher error: {e}")
+            finally:
+                conn.close()
+
+        threading.Thread(target=watch, name='tally-change-watcher', daemon=True).start()
+
+    def dashboard_cache_current(self, entry):
+        """Whether entry matches the last sync committed by any process.
+
+        Another worker may already have announced a save over /api/stream that
+        this worker's change watcher has not polled yet; serving the old body
+        (or a 304) then would leave that client stale until the next change.
+        """
+        conn = self.get_db_connection()
+        if not conn:
+            return True
+        try:
+            return self.read_last_sync(conn) in (None, entry['last_sync'])
+        except sqlite3.Error as e:
+            logging.error(f"Database query error: {e}")
+            return True
+        finally:
+            conn.close()
+
+    def read_last_sync(self, conn):
+        """sync_state.last_sync, the sync time a dashboard cache entry must match to be current"""
+        row = conn.execute("SELECT value FROM sync_state WHERE key = 'last_sync'").fetchone()
+        return row[0] if row else None
+
+    def change_stream(self, last_seen):
+        """SSE generator: one event per published change, comment keep-alives in between.
+
+        Blocks on a shared Condition instead of polling, so idle subscribers cost
+        nothing but a parked greenlet under gunicorn's gevent worker.
+        """
+        yield f"retry: {STREAM_RETRY_MS}\n\n"
+        while True:
+            with self.change_condition:
+                if last_seen < 0:
+                    last_seen = self.change_seq
+                self.change_condition.wait_for(
+                    lambda: self.change_event is not None and self.change_seq != last_seen,
+                    timeout=STREAM_KEEPALIVE_SECONDS)
+                seq, event = self.change_seq, self.change_event
+            if event is None or seq == last_seen:
+                yield ": keep-alive\n\n"
+                continue
+            last_seen = seq
+            yield f"id: {seq}\nevent: change\ndata: {event}\n\n"
+
+    def build_dashboard_data(self, conn):
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT name, type, closing_balance, due_date, parent_group, company, last_updated
+            FROM accounts 
+            ORDER BY closing_balance DESC
+        ''')
+        accounts = [dict(row) for row in cursor.fetchall()]
+        
+        total_debtors = sum(acc['closing_balance'] for acc in accounts if acc['type'] == 'debtor')
+        total_creditors = sum(acc['closing_balance'] for acc in accounts if acc['type'] == 'creditor')
+        
+        cursor.execute('''
+            SELECT COALESCE(
+                (SELECT value FROM sync_state WHERE key = 'last_sync'),
+                (SELECT MAX(last_updated) FROM accounts)
+            ) as last_update
+        ''')
+        last_update_row = cursor.fetchone()
+        last_update = last_update_row['last_update'] if last_update_row else None
+        
+        debtors = [acc for acc in accounts if acc['type'] == 'debtor']
+        creditors = [acc for acc in accounts if acc['type'] == 'creditor']
+        
+        return {
+            'summary': {
+                'total_debtors': total_debtors,
+                'total_creditors': total_creditors,
+                'net_position': total_debtors - total_creditors,
+                'total_accounts': len(accounts),
+                'debtors_count': len(debtors),
+                'creditors_count': len(creditors),
+                'last_updated': last_update
+            },
+            'debtors': debtors,
+            'creditors': creditors,
+            # Tied to the last sync, not the request; start_change_watcher keeps every worker on the same one
+            'timestamp': last_update
+        }
+
+    def build_cache_entry(self, data):
+        """Serialise a payload once, with its gzip body and a content-derived strong ETag"""
+        body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        return {
+            'etag': hashlib.sha256(body).hexdigest()[:32],
+            'body': body,
+            'gzip_body': gzip.compress(body, compresslevel=6),
+        }
+
+    def rebuild_dashboard_cache(self):
+        """Rebuild the dashboard response cache from the database and swap it in atomically"""
+        with self.dashboard_cache_lock:
+            conn = self.get_db_connection()
+            if not conn:
+                return None
+            try:
+                data = self.build_dashboard_data(conn)
+            except sqlite3.Error as e:
+                logging.error(f"Database query error: {e}")
+                return None
+            finally:
+                conn.close()
+            entry = self.build_cache_entry(data)
+            entry['last_sync'] = data['timestamp']
+            self.dashboard_cache = entry
+            logging.info(f"Dashboard cache rebuilt ({len(entry['body'])} bytes, {len(entry['gzip_body'])} gzipped)")
+            return entry
+
+    def cached_response(self, entry):
+        """Serve a cache entry, answering If-None-Match with 304 and gzip-encoding when accepted"""
+        use_gzip = request.accept_encodings.quality('gzip') > 0
+        # Strong ETags must differ per content-coding
+        etag = f"{entry['etag']}-gz" if use_gzip else entry['etag']
+        if request.if_none_match.contains(entry['etag']) or request.if_none_match.contains(f"{entry['etag']}-gz"):
+            response = Response(status=304)
+        else:
+            response = Response(entry['gzip_body'] if use_gzip else entry['body'], mimetype='application/json')
+            if use_gzip:
+                response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.vary.add('Accept-Encoding')
+        return response
 
     def get_db_connection(self):
-        """Get database connection with error handling"""
+        """Borrow a read-only connection from this worker's pool; close() returns it"""
+        if self.read_pool is None or self.read_pool_pid != os.getpid():
+            # Never share connections across a fork
+            self.read_pool = queue.LifoQueue(maxsize=READ_POOL_SIZE)
+            self.read_pool_pid = os.getpid()
         try:
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row
-            return conn
+            try:
+                conn = self.read_pool.get_nowait()
+            except queue.Empty:
+                conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+                conn.row_factory = sqlite3.Row
+            return PooledConnection(conn, self.read_pool)
         except sqlite3.Error as e:
             logging.error(f"Database connection error: {e}")
             return None
@@ -155,89 +1220,478 @@ class TallyDataExtractor:
         print(f"API server started on port {os.environ.get('PORT', 5000)}")
         logging.info("API server started")
 
+    def backup_marker(self, conn):
+        """Marker of the data's last change, used to skip backups when nothing changed.
+
+        Every save with changes writes a new last_change event (with its run
+        id) and every voucher load its vouchers:<company> state, so those
+        sync_state rows stand in for a content hash of the whole database.
+        """
+        rows = conn.execute("SELECT key, value FROM sync_state WHERE key = 'last_change' OR key LIKE 'vouchers:%' ORDER BY key").fetchall()
+        return hashlib.sha256(repr(rows).encode('utf-8')).hexdigest()
+
     def backup_database(self):
-        backup_path = os.path.join(self.backup_dir, f"tally_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db")
+        """Take an online SQLite backup if the data changed since the last one, then apply retention"""
+        if not self.backup_lock.acquire(blocking=False):
+            logging.info("Backup already in progress, skipping")
+            return None
+        hash_path = os.path.join(self.backup_dir, 'last_backup.sha256')
+        src = dst = None
         try:
-            if os.path.exists(self.db_path):
-                shutil.copy2(self.db_path, backup_path)
-                logging.info(f"Database backed up to {backup_path}")
+            if not os.path.exists(self.db_path):
+                return None
+            src = sqlite3.connect(self.db_path)
+            data_hash = self.backup_marker(src)
+            if os.path.exists(hash_path):
+                with open(hash_path, encoding='utf-8') as f:
+                    if f.read().strip() == data_hash:
+                        logging.info("Data unchanged since last backup, skipping")
+                        return None
+            backup_path = os.path.join(self.backup_dir, datetime.now().strftime(BACKUP_NAME_FORMAT))
+            dst = sqlite3.connect(backup_path)
+            # Copy in small steps so writers and API readers are never locked out for long
+            src.backup(dst, pages=256, sleep=0.01)
+            dst.close()
+            dst = None
+            with open(hash_path, 'w', encoding='utf-8') as f:
+                f.write(data_hash)
+            logging.info(f"Database backed up to {backup_path}")
+            self.prune_backups()
+            return backup_path
         except Exception as e:
             logging.error(f"Database backup failed: {e}")
+            return None
+        finally:
+            if dst:
+                dst.close()
+            if src:
+                src.close()
+            self.backup_lock.release()
+
+    def schedule_backup(self):
+        """Run backup_database in the background so extraction and API requests never wait on it"""
+        threading.Thread(target=self.backup_database, name='tally-backup', daemon=True).start()
+
+    def list_backups(self):
+        """Backup files as (timestamp, path) pairs, newest first"""
+        backups = []
+        for path in glob.glob(os.path.join(self.backup_dir, 'tally_data_*.db')):
+            try:
+                backups.append((datetime.strptime(os.path.basename(path), BACKUP_NAME_FORMAT), path))
+            except ValueError:
+                continue
+        return sorted(backups, reverse=True)
+
+    def prune_backups(self):
+        """Keep the newest backup of each of the last N hours, days and ISO weeks; delete the rest"""
+        periods = {
+            'hourly': lambda ts: ts.strftime('%Y%m%d%H'),
+            'daily': lambda ts: ts.strftime('%Y%m%d'),
+            'weekly': lambda ts: '%d-%02d' % ts.isocalendar()[:2],
+        }
+        keep = set()
+        for period, bucket_of in periods.items():
+            seen = set()
+            for ts, path in self.list_backups():
+                bucket = bucket_of(ts)
+                if bucket in seen:
+                    continue
+                if len(seen) >= self.backup_keep[period]:
+                    break
+                seen.add(bucket)
+                keep.add(path)
+        for ts, path in self.list_backups():
+            if path not in keep:
+                try:
+                    os.remove(path)
+                    logging.info(f"Pruned old backup {path}")
+                except OSError as e:
+                    logging.error(f"Failed to prune backup {path}: {e}")
+
+    def restore_database(self, backup_path=None):
+        """Restore the live database from a backup file (latest if not given) using the online backup API"""
+        if backup_path is None:
+            backups = self.list_backups()
+            if not backups:
+                print("No backups found")
+                return False
+            backup_path = backups[0][1]
+        if not os.path.exists(backup_path):
+            print(f"Backup not found: {backup_path}")
+            return False
+        src = sqlite3.connect(f"file:{backup_path}?mode=ro", uri=True)
+        dst = sqlite3.connect(self.db_path)
+        try:
+            src.backup(dst)
+            logging.info(f"Database restored from {backup_path}")
+            print(f"Database restored from {backup_path}")
+            return True
+        except sqlite3.Error as e:
+            logging.error(f"Database restore failed: {e}")
+            print(f"Database restore failed: {e}")
+            return False
+        finally:
+            dst.close()
+            src.close()
 
-    def fetch_ledger_data(self, group_name):
-        current_date = datetime.now().strftime('%d-%m-%Y')
-        xml_request = f'''
+    def tally_host(self, url):
+        """(request slots, keep-alive session) for a Tally host, shared by every tenant pointing at it"""
+        host = urlparse(url).netloc
+        with TALLY_HOSTS_LOCK:
+            if host not in TALLY_HOSTS:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=MAX_REQUESTS_PER_HOST)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                TALLY_HOSTS[host] = (threading.BoundedSemaphore(MAX_REQUESTS_PER_HOST), session)
+            return TALLY_HOSTS[host]
+
+    def normalize_tally_date(self, date_text):
+        """Convert Tally date strings (20240401, 1-Apr-2024, ...) to ISO YYYY-MM-DD; unknown formats pass through"""
+        date_text = (date_text or '').strip()
+        for fmt in TALLY_DATE_FORMATS:
+            try:
+                return datetime.strptime(date_text, fmt).strftime('%Y-%m-%d')
+            except ValueError:
+                continue
+        return date_text
+
+    def account_type_for_group(self, group_name):
+        group = group_name.lower()
+        if "debtor" in group:
+            return "debtor"
+        if "creditor" in group:
+            return "creditor"
+        return re.sub(r'[^a-z0-9]+', '_', group).strip('_')
+
+    def collection_request_xml(self, collection_id, collection_tdl, company=None, from_date=None, to_date=None):
+        """Wrap an inline TDL collection definition in a Tally export envelope"""
+        company_var = f"<SVCURRENTCOMPANY>{escape(company)}</SVCURRENTCOMPANY>" if company else ""
+        from_date = from_date.strftime('%d-%m-%Y') if from_date else '01-04-2023'
+        current_date = (to_date or datetime.now()).strftime('%d-%m-%Y')
+        return f'''
         <ENVELOPE>
             <HEADER>
                 <VERSION>1</VERSION>
                 <TALLYREQUEST>Export</TALLYREQUEST>
                 <TYPE>Collection</TYPE>
-                <ID>LedgerUnderGroup</ID>
+                <ID>{collection_id}</ID>
             </HEADER>
             <BODY>
                 <DESC>
                     <STATICVARIABLES>
                         <SVEXPORTFORMAT>$$SysName:XML</SVEXPORTFORMAT>
-                        <SVFROMDATE>01-04-2023</SVFROMDATE>
+                        <SVFROMDATE>{from_date}</SVFROMDATE>
                         <SVTODATE>{current_date}</SVTODATE>
+                        {company_var}
                     </STATICVARIABLES>
                     <TDL>
                         <TDLMESSAGE>
-                            <COLLECTION NAME="LedgerUnderGroup" ISMODIFY="No">
-                                <TYPE>Ledger</TYPE>
-                                <FETCH>Name, ClosingBalance, Parent, BillDate</FETCH>
-                                <FILTER>GroupFilter</FILTER>
-                            </COLLECTION>
-                            <SYSTEM TYPE="Formulae" NAME="GroupFilter">$Parent = "{group_name}"</SYSTEM>
+                            {collection_tdl}
                         </TDLMESSAGE>
                     </TDL>
                 </DESC>
             </BODY>
         </ENVELOPE>
         '''
+
+    def tally_request(self, tally_url, xml_request, label, handle_response, collection='LedgerUnderGroup'):
+        """POST to Tally under the per-host limit, retrying transient failures.
+
+        Returns handle_response(response), or None if the request or parsing
+        failed. Latency, parse time and payload size are recorded per collection.
+        """
+        slots, session = self.tally_host(tally_url)
+        for attempt in range(self.fetch_retries + 1):
+            try:
+                with slots:
+                    logging.info(f"Attempting to fetch data for group: {label}")
+                    print(f"Attempting to fetch data for group: {label}")
+                    started = time.perf_counter()
+                    response = session.post(
+                        tally_url,
+                        data=xml_request.encode('utf-8'),
+                        headers={'Content-Type': 'text/xml'},
+                        timeout=30,
+                        stream=self.streaming_parser
+                    )
+                    with response:
+                        response.raise_for_status()
+                        logging.info(f"HTTP Status: {response.status_code} for {label}")
+                        print(f"HTTP Status: {response.status_code} for {label}")
+                        received = time.perf_counter()
+                        result = handle_response(response)
+                        finished = time.perf_counter()
+                        self.metrics.observe('tally_request_seconds', finished - started, collection=collection)
+                        self.metrics.observe('tally_parse_seconds', finished - received, collection=collection)
+                        self.metrics.observe('tally_response_bytes', response.raw.tell(), collection=collection)
+                        self.unreachable_hosts.discard(urlparse(tally_url).netloc)
+                        return result
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError, requests.exceptions.HTTPError) as e:
+                retryable = not isinstance(e, requests.exceptions.HTTPError) or e.response is None or e.response.status_code >= 500
+                if retryable and attempt < self.fetch_retries:
+                    delay = self.fetch_backoff * (2 ** attempt)
+                    logging.warning(f"Request for {label} failed ({e}), retrying in {delay:.1f}s")
+                    print(f"Request for {label} failed, retrying in {delay:.1f}s")
+                    time.sleep(delay)
+                    continue
+                logging.error(f"Connection error for {label}: {e}")
+                print(f"Connection error for {label}: {e}")
+                self.metrics.inc('tally_request_failures_total', collection=collection)
+                if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+                    self.unreachable_hosts.add(urlparse(tally_url).netloc)
+                return None
+            except requests.exceptions.RequestException as e:
+                logging.error(f"Request error for {label}: {e}")
+                print(f"Request error for {label}: {e}")
+                self.metrics.inc('tally_request_failures_total', collection=collection)
+                return None
+            except ET.ParseError as e:
+                logging.error(f"XML parsing error for {label}: {e}")
+                print(f"XML parsing error for {label}: {e}")
+                self.metrics.inc('tally_request_failures_total', collection=collection)
+                return None
+            except Exception as e:
+                logging.error(f"Unexpected error fetching {label}: {e}")
+                print(f"Unexpected error fetching {label}: {e}")
+                self.metrics.inc('tally_request_failures_total', collection=collection)
+                return None
+
+    def fetch_ledger_data(self, group_name, company=None, tally_url=None, alter_filter=None, keep_zero=False):
+        """Fetch the ledgers of one group, or None if the request failed.
+
+        alter_filter narrows a delta run to altered ledgers. Zero balances are
+        kept for delta runs and whenever keep_zero is set (runs that are merged
+        rather than mirrored), so the caller can remove settled ledgers.
+        """
+        keep_zero = keep_zero or bool(alter_filter)
+        tally_url = tally_url or self.tally_url
+        label = f"{group_name} ({company})" if company else group_name
+        group_filter = f'$Parent = "{escape(group_name)}"'
+        if alter_filter:
+            group_filter = f"{group_filter} AND ({alter_filter})"
+        xml_request = self.collection_request_xml('LedgerUnderGroup', f'''
+                            <COLLECTION NAME="LedgerUnderGroup" ISMODIFY="No">
+                                <TYPE>Ledger</TYPE>
+                                <FETCH>Name, ClosingBalance, Parent, BillDate, AlterID</FETCH>
+                                <FILTER>GroupFilter</FILTER>
+                            </COLLECTION>
+                            <SYSTEM TYPE="Formulae" NAME="GroupFilter">{group_filter}</SYSTEM>
+        ''', company)
         
-        try:
-            logging.info(f"Attempting to fetch data for group: {group_name}")
-            print(f"Attempting to fetch data for group: {group_name}")
-            response = requests.post(
-                self.tally_url,
-                data=xml_request,
-                headers={'Content-Type': 'text/xml'},
-                timeout=30
-            )
-            
-            response.raise_for_status()
-            logging.info(f"HTTP Status: {response.status_code} for {group_name}")
-            print(f"HTTP Status: {response.status_code} for {group_name}")
-            
+        def handle_response(response):
+            if self.streaming_parser:
+                chunks = response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+                if self.debug_xml:
+                    chunks = self.dump_chunks(chunks, label)
+                accounts = list(self.iter_ledger_accounts(chunks, group_name, keep_zero))
+                logging.info(f"Extracted {len(accounts)} accounts for {label}")
+                print(f"Extracted {len(accounts)} accounts for {label}")
+                return accounts
             if not response.text.strip():
-                logging.warning(f"No data returned for {group_name}")
-                print(f"No data returned for {group_name}")
+                logging.warning(f"No data returned for {label}")
+                print(f"No data returned for {label}")
                 return []
-                
-            return self.parse_ledger_data(response.text, group_name)
-                
-        except requests.exceptions.ConnectionError as e:
-            logging.error(f"Connection error for {group_name}: {e}")
-            print(f"Connection error for {group_name}: {e}")
-            return []
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Request error for {group_name}: {e}")
-            print(f"Request error for {group_name}: {e}")
-            return []
-        except Exception as e:
-            logging.error(f"Unexpected error fetching {group_name}: {e}")
-            print(f"Unexpected error fetching {group_name}: {e}")
-            return []
+            return self.parse_ledger_data(response.text, group_name, keep_zero)
+        
+        accounts = self.tally_request(tally_url, xml_request, label, handle_response)
+        for account in accounts or []:
+            account['company'] = company
+        return accounts
+
+    def fetch_company_alter_ids(self, company, tally_url):
+        """Current (master, voucher) ALTERID high-water marks of a company, or None if unavailable"""
+        xml_request = self.collection_request_xml('CompanyAlterIds', '''
+                            <COLLECTION NAME="CompanyAlterIds" ISMODIFY="No">
+                                <TYPE>Company</TYPE>
+                                <FETCH>Name, AltMstId, AltVchId</FETCH>
+                            </COLLECTION>
+        ''', company)
+        
+        def handle_response(response):
+            for elem in self.iterparse_elements(response.iter_content(chunk_size=STREAM_CHUNK_SIZE), 'COMPANY'):
+                name = elem.get('NAME') or elem.findtext('NAME') or ''
+                if company and name.strip() != company:
+                    continue
+                try:
+                    return int(elem.findtext('ALTMSTID', '').strip()), int(elem.findtext('ALTVCHID', '').strip())
+                except ValueError:
+                    return None
+            return None
+        
+        return self.tally_request(tally_url, xml_request, f"ALTERIDs ({company or 'current company'})", handle_response,
+                                  collection='CompanyAlterIds')
+
+    def fetch_altered_voucher_ledgers(self, company, tally_url, since_alter_id):
+        """Names of ledgers posted to by vouchers altered after since_alter_id, or None on failure"""
+        xml_request = self.collection_request_xml('AlteredVouchers', f'''
+                            <COLLECTION NAME="AlteredVouchers" ISMODIFY="No">
+                                <TYPE>Voucher</TYPE>
+                                <FETCH>AlterID, PartyLedgerName, AllLedgerEntries.LedgerName</FETCH>
+                                <FILTER>AlteredSince</FILTER>
+                            </COLLECTION>
+                            <SYSTEM TYPE="Formulae" NAME="AlteredSince">$AlterID &gt; {int(since_alter_id)}</SYSTEM>
+        ''', company)
+        
+        def handle_response(response):
+            names = set()
+            for voucher in self.iterparse_elements(response.iter_content(chunk_size=STREAM_CHUNK_SIZE), 'VOUCHER'):
+                for elem in voucher.iter():
+                    if elem.tag in ('LEDGERNAME', 'PARTYLEDGERNAME') and elem.text and elem.text.strip():
+                        names.add(elem.text.strip())
+            return names
+        
+        return self.tally_request(tally_url, xml_request, f"altered vouchers ({company or 'current company'})", handle_response,
+                                  collection='AlteredVouchers')
+
+    def plan_company_fetch(self, company, tally_url):
+        """Decide how much of a company to fetch from its stored ALTERID watermark.
+
+        Returns (mode, alter_filter, watermark) where mode is 'skip' (nothing
+        altered), 'delta' (fetch ledgers matching alter_filter) or 'full'.
+        The watermark is what to persist once the run has been saved.
+        """
+        state_key = f"alterids:{company or ''}"
+        state = self.get_sync_state(state_key)
+        ids = self.fetch_company_alter_ids(company, tally_url)
+        if ids is None:
+            logging.warning(f"No ALTERIDs for {company or 'current company'}, doing a full fetch")
+            return 'full', None, None
+        now = datetime.now()
+        watermark = {'key': state_key, 'mst': ids[0], 'vch': ids[1], 'full_at': now.isoformat()}
+        if not state or now - datetime.fromisoformat(state['full_at']) >= timedelta(hours=self.full_reconcile_hours):
+            return 'full', None, watermark
+        watermark['full_at'] = state['full_at']
+        if ids == (state['mst'], state['vch']):
+            return 'skip', None, watermark
+        
+        clauses = []
+        if ids[0] != state['mst']:
+            clauses.append(f"$AlterID &gt; {int(state['mst'])}")
+        if ids[1] != state['vch']:
+            names = self.fetch_altered_voucher_ledgers(company, tally_url, state['vch'])
+            # No names means vouchers were deleted (or the request failed): only a full fetch can tell what moved
+            if not names or len(names) > DELTA_MAX_LEDGERS or any('"' in name for name in names):
+                watermark['full_at'] = now.isoformat()
+                return 'full', None, watermark
+            clauses.extend(f'$Name = "{escape(name)}"' for name in sorted(names))
+        return 'delta', ' OR '.join(clauses), watermark
+
+    def fetch_all_ledgers(self, targets=None):
+        """Fetch every configured group for every configured company concurrently.
 
-    def parse_ledger_data(self, xml_data, group_name):
+        targets optionally limits the run to a set of (company, group) pairs.
+        Returns (accounts, full_sync, watermarks). full_sync is False when any
+        company was fetched incrementally or partially or any request failed,
+        in which case accounts must be merged rather than mirrored. Watermarks
+        of companies with failed or skipped requests are dropped so their
+        changes are fetched again.
+        """
+        plans = {}
+        if self.incremental_extraction:
+            companies = [(c.get('name'), c.get('url') or self.tally_url) for c in self.tally_companies
+                         if targets is None or any((c.get('name'), group) in targets for group in c.get('groups') or self.ledger_groups)]
+            with ThreadPoolExecutor(max_workers=min(len(companies), 16) or 1, thread_name_prefix='tally-plan') as pool:
+                plans = dict(zip(companies, pool.map(lambda c: self.plan_company_fetch(*c), companies)))
+        
+        jobs = []
+        partial = set()
+        for company in self.tally_companies:
+            name, url = company.get('name'), company.get('url') or self.tally_url
+            mode, alter_filter, _ = plans.get((name, url), ('full', None, None))
+            if mode == 'skip':
+                logging.info(f"No ALTERID changes for {name or 'current company'}, skipping fetch")
+                continue
+            for group_name in company.get('groups') or self.ledger_groups:
+                if targets is not None and (name, group_name) not in targets:
+                    partial.add((name, url))
+                    continue
+                # A targeted run is merged, so settled ledgers must come back with their zero balance
+                jobs.append((group_name, name, url, alter_filter, targets is not None))
+        full_sync = not partial and all(plan[0] == 'full' for plan in plans.values())
+        if not jobs:
+            return [], full_sync, [plan[2] for key, plan in plans.items() if plan[2] and key not in partial]
+        
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=min(len(jobs), 16), thread_name_prefix='tally-fetch') as pool:
+            results = list(pool.map(lambda job: self.fetch_ledger_data(*job), jobs))
+        failed = {(job[1], job[2]) for job, batch in zip(jobs, results) if batch is None}
+        if failed:
+            full_sync = False
+        watermarks = [plan[2] for key, plan in plans.items() if plan[2] and key not in failed and key not in partial]
+        accounts = [account for batch in results if batch for account in batch]
+        logging.info(f"Fetched {len(accounts)} accounts from {len(jobs)} group requests in {time.monotonic() - started:.2f}s")
+        return accounts, full_sync, watermarks
+
+    def get_sync_state(self, key):
+        """JSON value stored under key in sync_state, or None"""
+        conn = self.get_db_connection()
+        if not conn:
+            return None
+        try:
+            row = conn.execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+            return json.loads(row[0]) if row else None
+        except (sqlite3.Error, ValueError) as e:
+            logging.error(f"Failed to read sync state {key}: {e}")
+            return None
+        finally:
+            conn.close()
+
+    def request_refresh(self):
+        """Record a refresh request for whichever process runs the scheduler; returns its id"""
+        request_id = time.time_ns()
+        conn = sqlite3.connect(self.db_path, timeout=DB_WRITE_TIMEOUT)
+        try:
+            # Ids only move forward so a scheduler that served a later request also covers this one
+            conn.execute('''
+                INSERT INTO sync_state (key, value) VALUES ('refresh_request', ?)
+                ON CONFLICT (key) DO UPDATE SET value = MAX(CAST(value AS INTEGER), CAST(excluded.value AS INTEGER))
+            ''', (str(request_id),))
+            conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Failed to queue refresh: {e}")
+            return None
+        finally:
+            conn.close()
+        if self.scheduler:
+            self.scheduler.wake()
+        return request_id
+
+    def wait_for_refresh(self, request_id, timeout):
+        """Poll the scheduler status until request_id has been served or timeout seconds pass"""
+        deadline = time.monotonic() + timeout
+        while True:
+            status = self.get_sync_state('scheduler_status')
+            if status and status.get('served_request', 0) >= request_id and status.get('state') == 'idle':
+                return status
+            if time.monotonic() >= deadline:
+                return status
+            time.sleep(min(0.5, max(deadline - time.monotonic(), 0)))
+
+    def set_sync_state(self, key, value):
+        conn = sqlite3.connect(self.db_path, timeout=DB_WRITE_TIMEOUT)
+        try:
+            conn.execute('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+            conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Failed to store sync state {key}: {e}")
+        finally:
+            conn.close()
+
+    def parse_ledger_data(self, xml_data, group_name, keep_zero=False):
+        """Parse a whole LedgerUnderGroup response (TALLY_STREAMING_PARSER=0).
+
+        Malformed responses raise, as on the streaming path, so tally_request
+        reports the group as failed instead of as empty.
+        """
         accounts = []
         try:
             xml_clean = re.sub(r'\sxmlns(?::\w+)?="[^"]+"', '', xml_data, count=1)
-            with open(f'tally_response_{group_name.lower().replace(" ", "_")}.xml', 'w', encoding='utf-8') as f:
-                f.write(xml_clean)
-            logging.info(f"Raw XML saved for {group_name}")
-            print(f"Raw XML saved for {group_name} (first 500 chars): {xml_clean[:500]}")
+            if self.debug_xml:
+                with open(self.debug_xml_path(group_name), 'w', encoding='utf-8') as f:
+                    f.write(xml_clean)
+                logging.debug("Raw XML saved for %s", group_name)
 
             try:
                 root = ET.fromstring(xml_clean)
@@ -247,23 +1701,19 @@ class TallyDataExtractor:
             
             ledger_count = len(root.findall('.//LEDGER'))
             logging.info(f"Found {ledger_count} LEDGER elements for {group_name}")
-            print(f"Found {ledger_count} LEDGER elements for {group_name}")
             if ledger_count == 0:
                 logging.warning(f"No valid LEDGER elements found in response for {group_name}")
                 print(f"No valid LEDGER elements found in response for {group_name}")
                 return []
 
+            debug = logging.getLogger().isEnabledFor(logging.DEBUG)
             for ledger in root.findall('.//LEDGER'):
                 name_elem = ledger.find('.//NAME')
                 if name_elem is None or not name_elem.text or not name_elem.text.strip():
                     name_elem = next((elem for elem in ledger.iter('NAME') if elem.text and elem.text.strip()), None)
                 name = name_elem.text.strip() if name_elem is not None and name_elem.text else f"Unnamed_{hash(str(ledger))}"
-                if name.startswith("Unnamed"):
-                    logging.warning(f"Unnamed ledger detected: {name} - Full XML: {ET.tostring(ledger, encoding='unicode', method='xml')}")
-                    print(f"Unnamed ledger detected: {name} - Full XML snippet: {ET.tostring(ledger, encoding='unicode', method='xml')[:200]}")
-                
-                logging.debug(f"Processing ledger: {name}")
-                print(f"Processing ledger: {name}")
+                if name.startswith("Unnamed") and debug:
+                    logging.debug("Unnamed ledger detected: %s - XML: %s", name, ET.tostring(ledger, encoding='unicode', method='xml')[:200])
                 
                 balance_elem = next((ledger.find(f'.//{tag}') for tag in ['CLOSINGBALANCE', 'CLBALANCE', 'BALANCE', 'AMOUNT', 'BALANCEAMOUNT', 'DRCRBALANCE', 'OPENINGBALANCE', 'LEDGERBALANCE'] if ledger.find(f'.//{tag}') is not None), None)
                 if balance_elem is None:
@@ -274,28 +1724,19 @@ class TallyDataExtractor:
                 
                 balance = 0.0
                 if balance_elem is not None:
-                    balance_text = balance_elem.text if balance_elem.text else '0'
-                    is_debit = balance_elem.get('DR', 'No').lower() == 'yes'
-                    is_credit = balance_elem.get('CR', 'No').lower() == 'yes'
-                    balance = self.parse_currency(balance_text)
-                    if is_debit:
-                        balance = abs(balance)
-                    elif is_credit:
-                        balance = -abs(balance)
-                    logging.debug(f"Found balance tag: {balance_elem.tag} with value: {balance_text}, Adjusted: {balance}")
-                    print(f"Found balance tag: {balance_elem.tag} with value: {balance_text}, Adjusted: {balance}")
+                    balance = parse_amount(balance_elem.text, balance_elem.attrib)
                 else:
-                    logging.warning(f"No balance tag found for {name}")
-                    print(f"No balance tag found for {name}")
+                    logging.debug("No balance tag found for %s", name)
                 
                 parent = parent_elem.text.strip() if parent_elem is not None and parent_elem.text else group_name
-                due_date = due_date_elem.text.strip() if due_date_elem is not None and due_date_elem.text else ""
+                due_date = self.normalize_tally_date(due_date_elem.text) if due_date_elem is not None and due_date_elem.text else ""
                 
-                logging.debug(f"Parsed: {name}, Balance: {balance}, Parent: {parent}")
-                print(f"Parsed: {name}, Balance: {balance}, Parent: {parent}")
+                if debug:
+                    logging.debug("Parsed: %s, Balance: %s, Parent: %s", name, balance, parent)
                 
-                if abs(balance) > 0.01:
-                    account_type = "debtor" if "debtor" in group_name.lower() else "creditor"
+                # Nameless LEDGER elements (such as CMPINFO's ledger count) are only worth keeping with a balance
+                if abs(balance) > 0.01 or (keep_zero and name_elem is not None):
+                    account_type = self.account_type_for_group(group_name)
                     accounts.append({
                         'name': name,
                         'type': account_type,
@@ -311,70 +1752,261 @@ class TallyDataExtractor:
         except ET.ParseError as e:
             logging.error(f"XML parsing error for {group_name}: {e} - Raw XML: {xml_data[:1000]}")
             print(f"XML parsing error for {group_name}: {e} - Raw XML snippet: {xml_data[:1000]}")
-            return []
+            raise
         except Exception as e:
             logging.error(f"Error processing {group_name} data: {e} - Raw XML: {xml_data[:1000]}")
             print(f"Error processing {group_name} data: {e} - Raw XML snippet: {xml_data[:1000]}")
-            return []
+            raise
+
+    def debug_xml_path(self, label):
+        return f"tally_response_{re.sub(r'[^a-z0-9]+', '_', label.lower()).strip('_')}.xml"
+
+    def dump_chunks(self, chunks, label):
+        """Pass response chunks through while copying them to the debug XML file"""
+        with open(self.debug_xml_path(label), 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        logging.debug("Raw XML saved for %s", label)
+
+    def iterparse_elements(self, chunks, tag):
+        """Incrementally parse an XML byte stream, yielding each complete `tag` element.
+
+        Works like ET.iterparse but drives expat with namespace processing
+        disabled, so Tally's undeclared prefixes (UDF:..., xmlns:UDF) are kept
+        as plain tag names instead of failing the parse. Elements outside of
+        `tag` are never built, and each yielded element is cleared afterwards.
+        """
+        builder = None
+        completed = []
+        depth = 0
+
+        def start(name, attrs):
+            nonlocal builder, depth
+            if not depth and name == tag:
+                builder = ET.TreeBuilder()
+            if depth or name == tag:
+                depth += 1
+                builder.start(name, attrs)
+
+        def end(name):
+            nonlocal depth
+            if depth:
+                depth -= 1
+                builder.end(name)
+                if not depth:
+                    completed.append(builder.close())
+
+        def data(text):
+            if depth:
+                builder.data(text)
+
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = data
 
-    def parse_currency(self, currency_text):
-        if not currency_text:
-            return 0.0
         try:
-            clean_text = re.sub(r'[₹,\s]', '', currency_text)
-            clean_text = re.sub(r'\s*(Dr|Cr)\s*', '', clean_text, flags=re.IGNORECASE)
-            match = re.search(r'-?\d+\.?\d*', clean_text)
-            value = float(match.group()) if match else float(clean_text) if clean_text else 0.0
-            logging.debug(f"Parsed currency '{currency_text}' to {value}")
-            print(f"Parsed currency '{currency_text}' to {value}")
-            return value
-        except ValueError as e:
-            logging.warning(f"Invalid currency format: {currency_text} - Error: {e}")
-            print(f"Invalid currency format: {currency_text} - Error: {e}")
-            return 0.0
-
-    def save_to_database(self, accounts):
-        self.backup_database()
+            for chunk in chunks:
+                if chunk:
+                    parser.Parse(chunk, False)
+                while completed:
+                    elem = completed.pop(0)
+                    yield elem
+                    elem.clear()
+            parser.Parse(b'', True)
+        except expat.ExpatError as e:
+            raise ET.ParseError(f"{expat.errors.messages[e.code]}: line {e.lineno}, column {e.offset}") from e
+        while completed:
+            elem = completed.pop(0)
+            yield elem
+            elem.clear()
+
+    def ledger_to_account(self, ledger, group_name, keep_zero=False):
+        """Build an account dict from a LEDGER element in a single pass over its subtree"""
+        name = None
+        balances = [None] * len(BALANCE_TAGS)
+        parent = None
+        due_dates = [None] * len(DUE_DATE_TAGS)
+
+        for elem in ledger.iter():
+            tag = elem.tag
+            if tag == 'NAME':
+                if name is None and elem.text and elem.text.strip():
+                    name = elem.text.strip()
+            elif tag in BALANCE_TAGS:
+                idx = BALANCE_TAGS.index(tag)
+                if balances[idx] is None:
+                    balances[idx] = elem
+            elif tag == 'PARENT':
+                if parent is None and elem in ledger:
+                    parent = elem
+            elif tag in DUE_DATE_TAGS:
+                idx = DUE_DATE_TAGS.index(tag)
+                if due_dates[idx] is None and elem in ledger:
+                    due_dates[idx] = elem
+
+        if name is None:
+            name = ledger.get('NAME', '').strip() or None
+        if name is None:
+            logging.debug("Skipping unnamed ledger in %s", group_name)
+            return None
+
+        balance_elem = next((elem for elem in balances if elem is not None), None)
+        due_date_elem = next((elem for elem in due_dates if elem is not None), None)
+
+        balance = 0.0
+        if balance_elem is not None:
+            balance = parse_amount(balance_elem.text, balance_elem.attrib)
+
+        if abs(balance) <= 0.01 and not keep_zero:
+            return None
+
+        return {
+            'name': name,
+            'type': self.account_type_for_group(group_name),
+            'balance': abs(balance),
+            'due_date': self.normalize_tally_date(due_date_elem.text) if due_date_elem is not None and due_date_elem.text else "",
+            'parent': parent.text.strip() if parent is not None and parent.text else group_name,
+            'last_updated': datetime.now().isoformat()
+        }
+
+    def iter_ledger_accounts(self, chunks, group_name, keep_zero=False):
+        """Stream account dicts out of a Tally LedgerUnderGroup response"""
+        for ledger in self.iterparse_elements(chunks, 'LEDGER'):
+            account = self.ledger_to_account(ledger, group_name, keep_zero)
+            if account is not None:
+                yield account
+
+    def parse_currency(self, currency_text):
+        """Kept for callers of the old API; see tally_amounts.parse_amount"""
+        return parse_amount(currency_text)
+
+    def save_to_database(self, accounts, started_at=None, prune=True):
+        """Sync accounts into the database, touching only ledgers that were added, changed or removed.
+
+        With prune=True the table mirrors `accounts` and missing ledgers are
+        deleted; with prune=False (delta runs) accounts are merged and only
+        those that came back with a zero balance are removed. Returns a dict of the (name, type, parent_group, company) keys that were inserted,
+        updated and deleted (None if the save failed); successful results are
+        also kept on self.last_sync_changes.
+        """
+        changes = {'inserted': [], 'updated': [], 'deleted': []}
+        conn = None
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = sqlite3.connect(self.db_path, timeout=DB_WRITE_TIMEOUT)
             cursor = conn.cursor()
-            cursor.execute('PRAGMA table_info(accounts)')
-            columns = [row[1] for row in cursor.fetchall()]
-            if 'due_date' not in columns:
-                cursor.execute('ALTER TABLE accounts ADD COLUMN due_date TEXT')
-                logging.info("Added due_date column to accounts table")
-            cursor.execute('DELETE FROM accounts')
+            synced_at = datetime.now().isoformat()
+
+            incoming = {}
+            zeroed = set()
             for account in accounts:
-                cursor.execute('''
-                    INSERT INTO accounts (name, type, closing_balance, due_date, parent_group, last_updated)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (
+                key = (account['name'], account['type'], account['parent'], account.get('company') or '')
+                if account['balance'] <= 0.01:
+                    zeroed.add(key)
+                else:
+                    incoming[key] = account
+
+            existing = {}
+            for row_id, name, acc_type, parent, company, balance, due_date in cursor.execute(
+                    'SELECT id, name, type, parent_group, company, closing_balance, due_date FROM accounts'):
+                existing[(name, acc_type, parent, company)] = (row_id, balance, due_date)
+
+            upserts = []
+            for key, account in incoming.items():
+                current = existing.get(key)
+                if current is None:
+                    changes['inserted'].append(key)
+                elif current[1] != account['balance'] or (current[2] or '') != (account['due_date'] or ''):
+                    changes['updated'].append(key)
+                else:
+                    continue
+                upserts.append((
                     account['name'],
                     account['type'],
                     account['balance'],
                     account['due_date'],
                     account['parent'],
-                    account['last_updated']
+                    key[3],
+                    account['last_updated'],
+                    synced_at
                 ))
+
+            changes['deleted'] = [key for key in existing if key not in incoming and (prune or key in zeroed)]
+            stale = [(existing[key][0],) for key in changes['deleted']]
+
+            cursor.executemany('''
+                INSERT INTO accounts (name, type, closing_balance, due_date, parent_group, company, last_updated, changed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (name, type, parent_group, company) DO UPDATE SET
+                    closing_balance = excluded.closing_balance,
+                    due_date = excluded.due_date,
+                    last_updated = excluded.last_updated,
+                    changed_at = excluded.changed_at
+            ''', upserts)
+            cursor.executemany('DELETE FROM accounts WHERE id = ?', stale)
+            cursor.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES ('last_sync', ?)", (synced_at,))
+            self.refresh_account_summary(cursor)
+            run_id = self.record_history(cursor, started_at or synced_at, synced_at, incoming, changes)
+            self.rollup_history(cursor)
+            if any(changes.values()):
+                # Stored so API workers in other processes can publish the same event
+                self.last_change_event = self.build_change_event(run_id, synced_at, changes, incoming)
+                cursor.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES ('last_change', ?)",
+                               (json.dumps(self.last_change_event, separators=(',', ':')),))
             conn.commit()
-            logging.info(f"Saved {len(accounts)} accounts to database")
-            print(f"Saved {len(accounts)} accounts to database")
+            self.last_sync_changes = changes
+            if any(changes.values()):
+                self.schedule_backup()
+            logging.info(f"Synced {len(incoming)} accounts to database: {len(changes['inserted'])} inserted, "
+                         f"{len(changes['updated'])} updated, {len(changes['deleted'])} deleted")
+            print(f"Synced {len(incoming)} accounts to database: {len(changes['inserted'])} inserted, "
+                  f"{len(changes['updated'])} updated, {len(changes['deleted'])} deleted")
         except sqlite3.Error as e:
             logging.error(f"Database save error: {e}")
             print(f"Database save error: {e}")
+            changes = None
         finally:
-            conn.close()
+            if conn:
+                conn.close()
+        return changes
 
-    def extract_and_save(self):
-        logging.info(f"Starting data extraction at {datetime.now()}")
-        print(f"Starting data extraction at {datetime.now()}")
+    def extract_and_save(self, targets=None):
+        """Fetch and save one run; targets limits it to a set of (company, group) pairs.
+
+        Returns a summary with the outcome ('saved', 'unchanged', 'failed' or
+        'empty'), the number of accounts fetched and counts of changed ledgers.
+        """
+        started_at = datetime.now()
+        logging.info(f"Starting data extraction at {started_at}")
+        print(f"Starting data extraction at {started_at}")
+        run_started = time.perf_counter()
+        status = 'empty'
+        changes = None
         
-        debtors = self.fetch_ledger_data("Sundry Debtors")
-        creditors = self.fetch_ledger_data("Sundry Creditors")
-        accounts = debtors + creditors
+        with self.metrics.timer('tally_extraction_phase_seconds', phase='fetch'):
+            accounts, full_sync, watermarks = self.fetch_all_ledgers(targets)
+        debtors = [a for a in accounts if a['type'] == 'debtor']
+        creditors = [a for a in accounts if a['type'] == 'creditor']
         
-        if accounts:
-            self.save_to_database(accounts)
+        if not accounts and watermarks and not full_sync:
+            # Incremental run where Tally reported no alterations
+            for watermark in watermarks:
+                self.set_sync_state(watermark.pop('key'), watermark)
+            logging.info("No ledger changes since last extraction")
+            print("No ledger changes since last extraction")
+            status = 'unchanged'
+        elif accounts:
+            with self.metrics.timer('tally_extraction_phase_seconds', phase='save'):
+                changes = self.save_to_database(accounts, started_at.isoformat(), prune=full_sync)
+            status = 'failed' if changes is None else 'saved'
+            if changes is not None:
+                for watermark in watermarks:
+                    self.set_sync_state(watermark.pop('key'), watermark)
+                self.rebuild_dashboard_cache()
+                if any(changes.values()):
+                    self.publish_change(self.last_change_event)
             total_debtors = sum(a['balance'] for a in accounts if a['type'] == 'debtor')
             total_creditors = sum(a['balance'] for a in accounts if a['type'] == 'creditor')
             
@@ -390,38 +2022,566 @@ class TallyDataExtractor:
             print("- Ensure Tally Prime is running with a company loaded.")
             print("- Enable web server: F12 > Advanced Configuration > Enable Company on Web = Yes.")
             print("- Verify debtors/creditors exist under 'Sundry Debtors' or 'Sundry Creditors' groups with non-zero balances.")
-            print("- Check console output, tally_extract.log, and XML files for details.")
+            print("- Check console output and tally_extract.log (set TALLY_DEBUG_XML=1 to save raw responses).")
 
-        logging.info("Extraction complete")
+        self.record_extraction_metrics(status, run_started, debtors, creditors)
+        logging.info(f"Extraction complete in {time.perf_counter() - run_started:.2f}s")
         print("Extraction complete")
+        return {
+            'status': status,
+            'full_sync': full_sync,
+            'accounts': len(accounts),
+            'changes': {kind: len(keys) for kind, keys in changes.items()} if changes else None
+        }
+
+    def record_extraction_metrics(self, status, run_started, debtors, creditors):
+        """Update run metrics and store them for API workers in other processes"""
+        self.metrics.observe('tally_extraction_phase_seconds', time.perf_counter() - run_started, phase='total')
+        self.metrics.inc('tally_extractions_total', status=status)
+        if status != 'unchanged':
+            self.metrics.set('tally_accounts', len(debtors), type='debtor')
+            self.metrics.set('tally_accounts', len(creditors), type='creditor')
+        self.metrics.set('tally_last_extraction_timestamp_seconds', round(time.time(), 3))
+        self.set_sync_state('extraction_metrics', self.metrics.snapshot('tally_'))
+
+    def fetch_voucher_window(self, company, tally_url, start, end):
+        """Fetch the vouchers dated start..end, or None if the request failed"""
+        xml_request = self.collection_request_xml('VoucherWindow', '''
+                            <COLLECTION NAME="VoucherWindow" ISMODIFY="No">
+                                <TYPE>Voucher</TYPE>
+                                <FETCH>GUID, Date, VoucherTypeName, VoucherNumber, PartyLedgerName, AlterID</FETCH>
+                                <FETCH>AllLedgerEntries.LedgerName, AllLedgerEntries.Amount</FETCH>
+                                <FETCH>AllLedgerEntries.BillAllocations.Name, AllLedgerEntries.BillAllocations.BillType</FETCH>
+                                <FETCH>AllLedgerEntries.BillAllocations.Amount, AllLedgerEntries.BillAllocations.BillCreditPeriod</FETCH>
+                            </COLLECTION>
+        ''', company, start, end)
+        label = f"vouchers {start:%Y-%m-%d}..{end:%Y-%m-%d}" + (f" ({company})" if company else "")
+        
+        def handle_response(response):
+            chunks = response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+            if self.debug_xml:
+                chunks = self.dump_chunks(chunks, label)
+            return self.parse_voucher_window(chunks, company or '')
+        
+        return self.tally_request(tally_url, xml_request, label, handle_response, collection='VoucherWindow')
+
+    def parse_voucher_window(self, chunks, company):
+        """Stream-parse a voucher export into (vouchers, bills) row lists ready for executemany"""
+        synced_at = datetime.now().isoformat()
+        vouchers, voucher_amounts = [], []
+        bills, bill_amounts = [], []
+        for voucher in self.iterparse_elements(chunks, 'VOUCHER'):
+            guid = (voucher.findtext('GUID') or voucher.get('REMOTEID') or '').strip()
+            voucher_date = self.normalize_tally_date(voucher.findtext('DATE'))
+            if not guid or not voucher_date:
+                logging.debug("Skipping voucher without GUID or date: %s", voucher.get('VCHTYPE'))
+                continue
+            party = (voucher.findtext('PARTYLEDGERNAME') or '').strip()
+            party_amount = None
+            for entry in voucher:
+                if entry.tag not in VOUCHER_ENTRY_TAGS:
+                    continue
+                ledger = (entry.findtext('LEDGERNAME') or '').strip()
+                if party_amount is None and ledger == party:
+                    party_amount = entry.findtext('AMOUNT')
+                for allocation in entry.iterfind('BILLALLOCATIONS.LIST'):
+                    bill_name = (allocation.findtext('NAME') or '').strip()
+                    if not bill_name:
+                        continue
+                    bills.append((company, guid, voucher_date, ledger, bill_name,
+                                  (allocation.findtext('BILLTYPE') or '').strip() or None,
+                                  self.bill_due_date(voucher_date, allocation.findtext('BILLCREDITPERIOD'))))
+                    bill_amounts.append(allocation.findtext('AMOUNT'))
+            try:
+                alter_id = int(voucher.findtext('ALTERID', '').strip())
+            except ValueError:
+                alter_id = None
+            vouchers.append((company, guid, voucher_date,
+                             (voucher.findtext('VOUCHERTYPENAME') or voucher.get('VCHTYPE') or '').strip() or None,
+                             (voucher.findtext('VOUCHERNUMBER') or '').strip() or None,
+                             party or None, alter_id, synced_at))
+            voucher_amounts.append(party_amount)
+        
+        voucher_amounts = parse_amounts(voucher_amounts)
+        bill_amounts = parse_amounts(bill_amounts)
+        return ([row + (amount,) for row, amount in zip(vouchers, voucher_amounts)],
+                [row + (amount,) for row, amount in zip(bills, bill_amounts)])
+
+    def bill_due_date(self, bill_date, credit_period):
+        """Due date from a BILLCREDITPERIOD of '30 Days' or an explicit date, else None"""
+        text = (credit_period or '').strip()
+        if not text:
+            return None
+        match = CREDIT_PERIOD_RE.match(text)
+        if match:
+            return (datetime.fromisoformat(bill_date) + timedelta(days=int(match.group(1)))).strftime('%Y-%m-%d')
+        due_date = self.normalize_tally_date(text)
+        try:
+            return datetime.strptime(due_date, '%Y-%m-%d').strftime('%Y-%m-%d')
+        except ValueError:
+            return None
+
+    def save_voucher_window(self, company, start, end, vouchers, bills):
+        """Replace the vouchers and bill allocations dated start..end in one transaction"""
+        window = (company, start.isoformat(), end.isoformat())
+        conn = None
+        try:
+            conn = sqlite3.connect(self.db_path, timeout=DB_WRITE_TIMEOUT)
+            # Safe under WAL: a crash can lose the last windows but not corrupt the database
+            conn.execute('PRAGMA synchronous=NORMAL')
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM bills WHERE company = ? AND date BETWEEN ? AND ?', window)
+            cursor.execute('DELETE FROM vouchers WHERE company = ? AND date BETWEEN ? AND ?', window)
+            # A voucher re-dated into this window still has allocations stored under its old date
+            cursor.executemany('DELETE FROM bills WHERE company = ? AND voucher_guid = ?', [(company, row[1]) for row in vouchers])
+            cursor.executemany('''
+                INSERT OR REPLACE INTO vouchers (company, guid, date, voucher_type, voucher_number, party_ledger, alter_id, synced_at, amount)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', vouchers)
+            cursor.executemany('''
+                INSERT INTO bills (company, voucher_guid, date, ledger_name, bill_name, bill_type, due_date, amount)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', bills)
+            conn.commit()
+            return True
+        except sqlite3.Error as e:
+            logging.error(f"Voucher save error for {start}..{end}: {e}")
+            print(f"Voucher save error for {start}..{end}: {e}")
+            return False
+        finally:
+            if conn:
+                conn.close()
+
+    def extract_vouchers(self, from_date=None, to_date=None):
+        """Load vouchers and bill allocations dated from_date..to_date for every configured company.
+
+        Defaults to the current financial year (from 1 April). The range is
+        requested in windows of voucher_window_days, a few at a time per
+        company, and each window is saved in its own transaction, so memory
+        and write-lock time are bounded by the window size however long the
+        range is. A window whose request failed is split in half and retried
+        down to single days; only failures that cannot be split further (a
+        single day, a failed save or an unreachable host) count towards giving
+        up on the company. Returns totals of vouchers and bills loaded and the windows that
+        could not be loaded.
+        """
+        today = datetime.now().date()
+        to_date = to_date or today
+        from_date = from_date or datetime(today.year if today.month >= 4 else today.year - 1, 4, 1).date()
+        totals = {'vouchers': 0, 'bills': 0, 'failed_windows': []}
+        started = time.perf_counter()
+        logging.info(f"Loading vouchers from {from_date} to {to_date}")
+        print(f"Loading vouchers from {from_date} to {to_date}")
+        
+        for company in self.tally_companies:
+            name, url = company.get('name'), company.get('url') or self.tally_url
+            windows = deque()
+            start = from_date
+            while start <= to_date:
+                end = min(start + timedelta(days=self.voucher_window_days - 1), to_date)
+                windows.append((start, end))
+                start = end + timedelta(days=1)
+            loaded = {'vouchers': 0, 'bills': 0}
+            failures = 0
+            with ThreadPoolExecutor(max_workers=self.max_requests_per_host, thread_name_prefix='tally-vouchers') as pool:
+                pending = deque()
+                while windows or pending:
+                    while windows and len(pending) < self.max_requests_per_host:
+                        start, end = windows.popleft()
+                        pending.append((start, end, pool.submit(self.fetch_voucher_window, name, url, start, end)))
+                    start, end, future = pending.popleft()
+                    result = future.result()
+                    if result is not None and self.save_voucher_window(name or '', start, end, *result):
+                        failures = 0
+                        loaded['vouchers'] += len(result[0])
+                        loaded['bills'] += len(result[1])
+                        continue
+                    if result is None and end > start and urlparse(url).netloc not in self.unreachable_hosts:
+                        # Smaller windows give Tally smaller responses to build
+                        middle = start + (end - start) // 2
+                        windows.extendleft([(middle + timedelta(days=1), end), (start, middle)])
+                        continue
+                    failures += 1
+                    if failures >= VOUCHER_MAX_CONSECUTIVE_FAILURES:
+                        logging.error(f"Giving up on vouchers for {name or 'current company'} after {failures} failed windows")
+                        print(f"Giving up on vouchers for {name or 'current company'} after {failures} failed windows")
+                        totals['failed_windows'].append((name, start, end))
+                        for _, _, future in pending:
+                            future.cancel()
+                        totals['failed_windows'] += [(name, *window[:2]) for window in list(pending) + list(windows)]
+                        break
+                    totals['failed_windows'].append((name, start, end))
+            
+            totals['vouchers'] += loaded['vouchers']
+            totals['bills'] += loaded['bills']
+            self.set_sync_state(f"vouchers:{name or ''}", {
+                'from': from_date.isoformat(),
+                'to': to_date.isoformat(),
+                'loaded_at': datetime.now().isoformat(),
+                **loaded,
+                'failed_windows': [[start.isoformat(), end.isoformat()] for company_name, start, end in totals['failed_windows'] if company_name == name]
+            })
+        
+        elapsed = time.perf_counter() - started
+        self.metrics.observe('tally_extraction_phase_seconds', elapsed, phase='vouchers')
+        logging.info(f"Loaded {totals['vouchers']} vouchers and {totals['bills']} bill allocations in {elapsed:.1f}s, "
+                     f"{len(totals['failed_windows'])} windows failed")
+        print(f"Loaded {totals['vouchers']} vouchers and {totals['bills']} bill allocations in {elapsed:.1f}s, "
+              f"{len(totals['failed_windows'])} windows failed")
+        return totals
+
+class TenantDispatcher:
+    """WSGI middleware sending /t/<tenant>/... to that tenant's extractor app.
+
+    Extractors (and so their databases, read pools and caches) are created on
+    the tenant's first request, after Flask's lazy application dispatching
+    pattern. Routing costs a dict lookup however many tenants are configured.
+    """
+    def __init__(self, tenants, default_app, on_create=None):
+        self.tenants = tenants
+        self.default_app = default_app
+        self.on_create = on_create
+        self.extractors = {}
+        self.lock = threading.Lock()
+
+    def get_extractor(self, tenant_id):
+        extractor = self.extractors.get(tenant_id)
+        if extractor is None:
+            with self.lock:
+                extractor = self.extractors.get(tenant_id)
+                if extractor is None:
+                    extractor = TallyDataExtractor(self.tenants[tenant_id])
+                    if self.on_create:
+                        self.on_create(extractor)
+                    self.extractors[tenant_id] = extractor
+                    logging.info(f"Loaded tenant {tenant_id} ({len(self.extractors)}/{len(self.tenants)})")
+        return extractor
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path.startswith('/t/'):
+            tenant_id, _, rest = path[3:].partition('/')
+            if tenant_id in self.tenants:
+                environ['SCRIPT_NAME'] = f"{environ.get('SCRIPT_NAME', '')}/t/{tenant_id}"
+                environ['PATH_INFO'] = f"/{rest}"
+                return self.get_extractor(tenant_id).app(environ, start_response)
+        return self.default_app(environ, start_response)
+
+def load_tenants(path=None):
+    """Tenant configs keyed by id from TALLY_TENANTS_FILE, or {} for a single-tenant deployment.
+
+    The file is a JSON object mapping tenant ids to {"api_key": ...,
+    "tally_url": ..., "company": ... or "companies": [...], "groups": [...],
+    "db_path": ..., "backup_dir": ...}. Only api_key is required.
+    """
+    path = path or TENANTS_FILE
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    tenants = {}
+    for tenant_id, tenant in config.items():
+        if not TENANT_ID_RE.match(tenant_id):
+            raise ValueError(f"Invalid tenant id {tenant_id!r}: use up to 64 letters, digits, '_' or '-'")
+        if not tenant.get('api_key'):
+            raise ValueError(f"Tenant {tenant_id} has no api_key")
+        tenants[tenant_id] = dict(tenant, id=tenant_id)
+    logging.info(f"Loaded {len(tenants)} tenant configs from {path}")
+    return tenants
+
+def create_tenant_app(tenants, on_create=None):
+    """Flask app serving /api/health itself and each tenant's API under /t/<tenant>/api/..."""
+    app = Flask(__name__)
+    dispatcher = TenantDispatcher(tenants, app.wsgi_app, on_create)
+    app.wsgi_app = dispatcher
+    app.extensions['tenants'] = dispatcher
+
+    @app.route('/api/health', methods=['GET'])
+    def health_check():
+        return jsonify({
+            'status': 'healthy',
+            'timestamp': datetime.now().isoformat(),
+            'tenants': len(tenants),
+            'tenants_loaded': len(dispatcher.extractors)
+        })
+
+    return app
 
 def main():
+    parser = argparse.ArgumentParser(description="Tally Dashboard Data Extractor with API")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('run', help="Start the API server and scheduled extraction (default)")
+    subparsers.add_parser('extract', help="Run only the scheduled extraction (pair with gunicorn serving create_app())")
+    subparsers.add_parser('backup', help="Take a backup now if the data changed")
+    subparsers.add_parser('list-backups', help="List available backups, newest first")
+    vouchers_parser = subparsers.add_parser('extract-vouchers', help="Load vouchers and bill allocations for a date range")
+    vouchers_parser.add_argument('--from', dest='from_date', type=lambda text: datetime.strptime(text, '%Y-%m-%d').date(),
+                                 help="First voucher date, YYYY-MM-DD (default: start of the financial year)")
+    vouchers_parser.add_argument('--to', dest='to_date', type=lambda text: datetime.strptime(text, '%Y-%m-%d').date(),
+                                 help="Last voucher date, YYYY-MM-DD (default: today)")
+    restore_parser = subparsers.add_parser('restore', help="Restore the database from a backup")
+    restore_parser.add_argument('backup_path', nargs='?', help="Backup file to restore (default: latest)")
+    parser.add_argument('--tenant', help="Tenant id from the tenants file for backup, restore and voucher commands")
+    args = parser.parse_args()
+    
+    tenants = load_tenants()
+    if args.tenant and args.tenant not in tenants:
+        parser.error(f"unknown tenant {args.tenant!r}")
+    
+    def make_extractor():
+        return TallyDataExtractor(tenants[args.tenant] if args.tenant else None)
+    
+    if args.command == 'backup':
+        path = make_extractor().backup_database()
+        print(f"Database backed up to {path}" if path else "No backup taken")
+        return
+    if args.command == 'list-backups':
+        for ts, path in make_extractor().list_backups():
+            print(f"{ts.isoformat()}  {path}")
+        return
+    if args.command == 'restore':
+        sys.exit(0 if make_extractor().restore_database(args.backup_path) else 1)
+    if args.command == 'extract-vouchers':
+        totals = make_extractor().extract_vouchers(args.from_date, args.to_date)
+        for company, start, end in totals['failed_windows']:
+            print(f"Failed: {company or 'current company'} {start}..{end}")
+        sys.exit(1 if totals['failed_windows'] else 0)
+    
+    if args.command == 'extract':
+        print("Tally Dashboard Data Extractor - extraction only")
+        try:
+            if tenants:
+                run_tenant_schedulers([TallyDataExtractor(tenant) for tenant in tenants.values()])
+            else:
+                run_scheduler(TallyDataExtractor())
+        except KeyboardInterrupt:
+            logging.info("Extractor stopped by user")
+            print("\nExtractor stopped")
+        return
+    
     print("Tally Dashboard Data Extractor with API - Enhanced Version")
     print("=========================================================")
     
+    if tenants:
+        app = create_tenant_app(tenants)
+        dispatcher = app.extensions['tenants']
+        threading.Thread(target=app.run, kwargs={'host': '0.0.0.0', 'port': int(os.environ.get('PORT', 5000)),
+                                                 'debug': False, 'use_reloader': False}, daemon=True).start()
+        print(f"- Tenants: {len(tenants)}, served under /t/<tenant>/api/")
+        try:
+            run_tenant_schedulers([dispatcher.get_extractor(tenant_id) for tenant_id in tenants])
+        except KeyboardInterrupt:
+            logging.info("System stopped by user")
+            print("\nSystem stopped")
+        return
+    
     extractor = TallyDataExtractor()
     
     # Start API server first
     extractor.start_api_server()
     
-    # Initial data extraction
-    extractor.extract_and_save()
-    
-    # Schedule hourly updates
-    schedule.every().hour.do(extractor.extract_and_save)
-    
     print("System running:")
-    print("- Data extractor: Updating every hour")
+    print(f"- Data extractor: Updating every {int(os.environ.get('TALLY_REFRESH_INTERVAL', 3600)) // 60} minutes (POST /api/refresh for now)")
     print(f"- API server: Running on port {os.environ.get('PORT', 5000)}")
     print("- Press Ctrl+C to stop")
     
     try:
-        while True:
-            schedule.run_pending()
-            time.sleep(60)
+        run_scheduler(extractor)
     except KeyboardInterrupt:
         logging.info("System stopped by user")
         print("\nSystem stopped")
 
+class ExtractionScheduler:
+    """Runs extractions on per-company/group intervals, one at a time.
+
+    Intervals come from TALLY_REFRESH_INTERVAL, overridden per company by
+    "interval" and per group by "intervals" in TALLY_COMPANIES. Outside
+    TALLY_BUSINESS_HOURS (e.g. "09:00-19:00") intervals are stretched to at
+    least TALLY_OFF_HOURS_INTERVAL. Targets falling due close together share
+    a run, and refresh requests arriving mid-run are served by one follow-up
+    run. Hosts that refuse connections are retried with exponential backoff
+    instead of on their interval.
+    """
+    def __init__(self, extractor):
+        self.extractor = extractor
+        self.wakeup = threading.Condition()
+        self.run_lock = threading.Lock()
+        self.default_interval = float(os.environ.get('TALLY_REFRESH_INTERVAL', 3600))
+        self.jitter = float(os.environ.get('TALLY_SCHEDULE_JITTER', 0.1))
+        self.backoff_base = float(os.environ.get('TALLY_BACKOFF_BASE', 30))
+        self.backoff_max = float(os.environ.get('TALLY_BACKOFF_MAX', 1800))
+        self.business_hours = self.parse_business_hours(os.environ.get('TALLY_BUSINESS_HOURS', ''))
+        self.off_hours_interval = float(os.environ.get('TALLY_OFF_HOURS_INTERVAL', 3600))
+        self.intervals = {}
+        for company in extractor.tally_companies:
+            name, url = company.get('name'), company.get('url') or extractor.tally_url
+            for group_name in company.get('groups') or extractor.ledger_groups:
+                self.intervals[(name, url, group_name)] = float(
+                    (company.get('intervals') or {}).get(group_name) or company.get('interval') or self.default_interval)
+        self.next_due = {}
+        self.host_failures = {}
+        self.last_full_run = None
+        self.run_count = 0
+        self.served_request = 0
+        self.status = {'state': 'idle', 'run': 0, 'served_request': 0}
+
+    def parse_business_hours(self, text):
+        """'09:00-19:00' -> (start, end) as datetime.time, or None for always"""
+        if not text.strip():
+            return None
+        try:
+            start, end = (datetime.strptime(part.strip(), '%H:%M').time() for part in text.split('-'))
+        except ValueError:
+            logging.warning(f"Ignoring TALLY_BUSINESS_HOURS={text!r}; expected HH:MM-HH:MM")
+            return None
+        return start, end
+
+    def interval_for(self, target):
+        interval = self.intervals[target]
+        if self.business_hours:
+            start, end = self.business_hours
+            now = datetime.now().time()
+            inside = start <= now < end if start <= end else (now >= start or now < end)
+            if not inside:
+                interval = max(interval, self.off_hours_interval)
+        return interval
+
+    def wake(self):
+        with self.wakeup:
+            self.wakeup.notify_all()
+
+    def pending_request(self):
+        """Id of a refresh request newer than the last one served, or None"""
+        value = self.extractor.get_sync_state('refresh_request')
+        return value if isinstance(value, int) and value > self.served_request else None
+
+    def publish_status(self, **fields):
+        self.status.update(fields)
+        self.extractor.set_sync_state('scheduler_status', self.status)
+
+    def run(self, targets, reason, request_id=None):
+        """Extract the given targets unless a run is already in progress"""
+        if not self.run_lock.acquire(blocking=False):
+            return None
+        try:
+            self.run_count += 1
+            full = set(targets) == set(self.intervals)
+            self.publish_status(state='running', run=self.run_count, reason=reason, full=full,
+                                started_at=datetime.now().isoformat(), finished_at=None, result=None, error=None)
+            result, error = None, None
+            try:
+                with EXTRACTION_SLOTS:
+                    result = self.extractor.extract_and_save(None if full else {(name, group) for name, _, group in targets})
+            except Exception as e:
+                logging.exception(f"Extraction run {self.run_count} failed")
+                error = str(e)
+            
+            now = time.monotonic()
+            if full:
+                self.last_full_run = now
+            backoff = {}
+            for host in {urlparse(url).netloc for _, url, _ in targets}:
+                if host in self.extractor.unreachable_hosts:
+                    failures = self.host_failures[host] = self.host_failures.get(host, 0) + 1
+                    backoff[host] = min(self.backoff_base * 2 ** (failures - 1), self.backoff_max)
+                    logging.warning(f"Tally at {host} unreachable ({failures} runs), retrying in {backoff[host]:.0f}s")
+                else:
+                    self.host_failures.pop(host, None)
+            for target in targets:
+                host = urlparse(target[1]).netloc
+                delay = backoff.get(host) or self.interval_for(target) * (1 + random.uniform(-self.jitter, self.jitter))
+                self.next_due[target] = now + delay
+            if request_id:
+                self.served_request = max(self.served_request, request_id)
+            
+            next_at = datetime.now() + timedelta(seconds=max(min(self.next_due.values()) - now, 0))
+            self.publish_status(state='idle', finished_at=datetime.now().isoformat(), result=result, error=error,
+                                served_request=self.served_request, next_run_at=next_at.isoformat(timespec='seconds'),
+                                backoff={host: round(delay) for host, delay in backoff.items()})
+            return result
+        finally:
+            self.run_lock.release()
+
+    def run_forever(self):
+        """Initial full extraction, then scheduled and requested runs; blocks forever"""
+        self.run(list(self.intervals), 'startup', self.pending_request())
+        while True:
+            request_id = self.pending_request()
+            if request_id:
+                self.run(list(self.intervals), 'refresh', request_id)
+                continue
+            now = time.monotonic()
+            due = [target for target, at in self.next_due.items() if at <= now]
+            if due:
+                # Periodically fetch everything so ledgers deleted in Tally are pruned
+                full_interval = max(self.interval_for(target) for target in self.intervals)
+                if self.last_full_run is None or now - self.last_full_run >= full_interval:
+                    due = list(self.intervals)
+                else:
+                    due = [target for target, at in self.next_due.items() if at <= now + SCHEDULE_COALESCE_SECONDS]
+                self.run(due, 'schedule')
+                continue
+            # Wake for the next due target, or sooner to pick up refresh requests from other processes
+            with self.wakeup:
+                self.wakeup.wait(min(min(self.next_due.values()) - now, CHANGE_POLL_SECONDS))
+
+def run_scheduler(extractor):
+    """Run the extraction scheduler in this thread; blocks forever"""
+    extractor.scheduler = ExtractionScheduler(extractor)
+    extractor.scheduler.run_forever()
+
+def run_tenant_schedulers(extractors):
+    """One scheduler thread per tenant, sharing EXTRACTION_SLOTS; blocks forever"""
+    threads = [threading.Thread(target=run_scheduler, args=(extractor,), name=f"tally-scheduler-{extractor.tenant_id}", daemon=True)
+               for extractor in extractors]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+_extractor_lock_file = None
+
+def acquire_extractor_lock():
+    """Non-blocking file lock so exactly one gunicorn worker runs the embedded extractor"""
+    global _extractor_lock_file
+    try:
+        import fcntl
+    except ImportError:
+        logging.warning("Embedded extractor needs fcntl; run the 'extract' command as a separate process instead")
+        return False
+    lock_file = open(EXTRACTOR_LOCK_PATH, 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _extractor_lock_file = lock_file
+    return True
+
+def create_app():
+    """WSGI app factory for gunicorn.
+
+    Workers only serve the API. Extraction runs in the separate `extract`
+    process, or, with TALLY_EMBEDDED_EXTRACTOR=1, in whichever worker wins
+    the extractor file lock. With a tenants file, each tenant is served
+    under /t/<tenant>/ and loaded on its first request.
+    """
+    tenants = load_tenants()
+    if tenants:
+        app = create_tenant_app(tenants, on_create=lambda extractor: extractor.start_change_watcher())
+        if os.environ.get('TALLY_EMBEDDED_EXTRACTOR') == '1' and acquire_extractor_lock():
+            logging.info(f"Worker {os.getpid()} elected to run the embedded extractor for {len(tenants)} tenants")
+            dispatcher = app.extensions['tenants']
+            threading.Thread(target=lambda: run_tenant_schedulers([dispatcher.get_extractor(tenant_id) for tenant_id in tenants]),
+                             name='tally-schedulers', daemon=True).start()
+        return app
+    
+    extractor = TallyDataExtractor()
+    extractor.start_change_watcher()
+    if os.environ.get('TALLY_EMBEDDED_EXTRACTOR') == '1' and acquire_extractor_lock():
+        logging.info(f"Worker {os.getpid()} elected to run the embedded extractor")
+        threading.Thread(target=run_scheduler, args=(extractor,), name='tally-scheduler', daemon=True).start()
+    return extractor.app
+
 if __name__ == "__main__":
     main()